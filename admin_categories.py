@@ -2,6 +2,7 @@ import logging
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 import database as db
+import stock_import
 from strings import STRINGS
 from admin_handlers import is_admin
 
@@ -216,7 +217,7 @@ async def stock_type_selected(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif type_str == 'link':
         await query.edit_message_text("Send the link below:\n(Or send /done when finished)")
     elif type_str == 'code':
-        await query.edit_message_text("Send codes (one per message, or multiple codes separated by newlines):\n(Send /done when finished)")
+        await query.edit_message_text("Send codes (one per message, or multiple codes separated by newlines),\nor upload a .txt/.csv/.zip file with one code per line:\n(Send /done when finished)")
         
     return STOCK_INPUT
 
@@ -239,24 +240,37 @@ async def stock_input_received(update: Update, context: ContextTypes.DEFAULT_TYP
             await update.message.reply_text("❌ Please upload a file.")
             return STOCK_INPUT
             
-        file_id = update.message.document.file_id
-        db.add_stock_item(prod_id, 'file', file_id=file_id)
+        # The same file uploaded again adds a unit to its shared asset
+        document = update.message.document
+        units = db.add_asset_stock(prod_id, 'file', file_id=document.file_id)
         qty_added = 1
-        await update.message.reply_text("✅ File saved! Send another file or /done.")
+        await update.message.reply_text(f"✅ File saved ({units} in stock)! Send another file or /done.")
         
     elif stype == 'link':
         if not update.message.text:
             return STOCK_INPUT
-        db.add_stock_item(prod_id, 'link', content=update.message.text)
+        units = db.add_asset_stock(prod_id, 'link', content=update.message.text)
         qty_added = 1
-        await update.message.reply_text("✅ Link saved! Send another or /done.")
+        await update.message.reply_text(f"✅ Link saved ({units} in stock)! Send another or /done.")
         
     elif stype == 'code':
-        if not update.message.text:
+        if update.message.document:
+            # Large batches come as a .txt/.csv/.zip upload, streamed in chunks.
+            # Run it as a task: the conversation must not hold up other users'
+            # updates for the length of the import; progress edits report status.
+            context.application.create_task(
+                _import_stock_file(update.message, prod_id, was_empty, context), update=update
+            )
+            await update.message.reply_text("Send more codes or another file, or /done.")
+        elif not update.message.text:
             return STOCK_INPUT
-        codes = update.message.text.split("\n")
-        qty_added = db.add_stock_items_bulk(prod_id, 'code', codes)
-        await update.message.reply_text(f"✅ Saved {qty_added} codes! Send more or /done.")
+        else:
+            codes = update.message.text.split("\n")
+            qty_added, duplicates = db.add_stock_items_bulk(prod_id, 'code', codes)
+            msg = f"✅ Saved {qty_added} codes! Send more or /done."
+            if duplicates:
+                msg += f"\n♻️ Skipped {duplicates} duplicate codes."
+            await update.message.reply_text(msg)
         
     if was_empty and qty_added > 0:
         from admin_handlers import trigger_restock_notifications
@@ -264,6 +278,12 @@ async def stock_input_received(update: Update, context: ContextTypes.DEFAULT_TYP
 
     return STOCK_INPUT
 
+async def _import_stock_file(message, prod_id, was_empty, context):
+    stats = await stock_import.import_document(context.bot, message, prod_id, 'code')
+    if was_empty and stats and stats['added'] > 0:
+        from admin_handlers import trigger_restock_notifications
+        await trigger_restock_notifications(prod_id, context)
+
 async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("❌ Operation cancelled.", reply_markup=ReplyKeyboardRemove())
     context.user_data.clear()
@@ -3,15 +3,21 @@ Admin Panel Handlers for Telegram Digital Bot
 Handles all admin-only operations including product management.
 """
 import datetime
+import html
 import traceback
-import asyncio
+import logging
 
 import os
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.ext import ContextTypes, ConversationHandler
 import database as db
+import broadcast
+import perf
+import restock_notifier
 from strings import STRINGS
 
+logger = logging.getLogger(__name__)
+
 # Get admin credentials from environment
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "").lower()
@@ -62,7 +68,7 @@ def is_command_button(text: str) -> bool:
         "➕ Add Product", "✏️ Edit Product", "🗑️ Delete Product",
         "📦 Manage Stock", "📤 Manage Files", "🔑 Manage Codes",
         "📊 Recent Orders", "👥 Users Stats", "🚫 Ban Management",
-        "➕ Add Balance",
+        "➕ Add Balance", "📮 Stuck Deliveries",
         "⬅️ Back", "/start", "/admin", "/ad"
     ]
     return text in buttons or text.startswith("/")
@@ -83,7 +89,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         ["🗑️ Delete Product", "📊 Recent Orders"],
         ["👥 Users Stats", "🚫 Ban Management"],
         ["➕ Add Balance", "🧹 Reset catalog"],
-        ["⬅️ Back"]
+        ["📮 Stuck Deliveries", "⬅️ Back"]
     ]
     
     await update.message.reply_text(
@@ -157,7 +163,7 @@ async def reset_catalog_action(update: Update, context: ContextTypes.DEFAULT_TYP
             # Count beforehand for logging
             c.execute("SELECT COUNT(*) FROM favorites")
             favs = c.fetchone()[0]
-            c.execute("SELECT COUNT(*) FROM stock_items")
+            c.execute("SELECT COUNT(*) FROM stock_items_all")
             stocks = c.fetchone()[0]
             c.execute("SELECT COUNT(*) FROM products")
             prods = c.fetchone()[0]
@@ -166,6 +172,8 @@ async def reset_catalog_action(update: Update, context: ContextTypes.DEFAULT_TYP
             
             c.execute("DELETE FROM favorites")
             c.execute("DELETE FROM stock_items")
+            c.execute("DELETE FROM stock_items_archive")
+            c.execute("DELETE FROM delivery_assets")
             c.execute("DELETE FROM products")
             c.execute("DELETE FROM categories")
             
@@ -554,14 +562,14 @@ async def admin_delete_confirm_callback(update: Update, context: ContextTypes.DE
         product_id = context.user_data['delete_product_id']
         
         # Log deletion
-        print(f"[ADMIN DELETE] product_id={product_id} deleted_by={update.effective_user.id}")
+        logger.info(f"[ADMIN DELETE] product_id={product_id} deleted_by={update.effective_user.id}")
         
         # Execute deletion
         try:
             db.delete_product(product_id)
             await query.edit_message_text(f"✅ Product (ID: {product_id}) deleted successfully!")
         except Exception as e:
-            print(f"Error deleting product: {e}")
+            logger.error(f"Error deleting product: {e}")
             await query.edit_message_text(f"❌ Error deleting product: {str(e)}")
             
     else:
@@ -577,7 +585,7 @@ async def admin_delete_confirm_callback(update: Update, context: ContextTypes.DE
 async def start_manage_stock(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Show list of products to manage stock."""
     user = update.effective_user
-    print(f"[ADMIN STOCK] step=start user_id={user.id}")
+    logger.info(f"[ADMIN STOCK] step=start user_id={user.id}")
     
     lang = get_lang(user.id)
     
@@ -613,12 +621,13 @@ async def stock_product_selected(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data['stock_product_id'] = product_id
         context.user_data['stock_delivery_type'] = product['delivery_type']
         
-        print(f"[ADMIN STOCK] step=choose_product product_id={product_id} type={product['delivery_type']}")
+        logger.info(f"[ADMIN STOCK] step=choose_product product_id={product_id} type={product['delivery_type']}")
         
+        unlimited_hint = " or ∞ for unlimited" if product['delivery_type'] in ('link', 'file') else ""
         await update.message.reply_text(
             f"📦 Selected: {product['title_en']}\n"
             f"Current Stock: {product['stock']}\n\n"
-            "Enter quantity to ADD (e.g. 5):"
+            f"Enter quantity to ADD (e.g. 5{unlimited_hint}):"
         )
         return STOCK_ENTER_QTY
     except ValueError:
@@ -626,49 +635,12 @@ async def stock_product_selected(update: Update, context: ContextTypes.DEFAULT_T
         return STOCK_SELECT_PRODUCT
 
 async def trigger_restock_notifications(product_id: int, context: ContextTypes.DEFAULT_TYPE):
-    """Notify users who favorited this product if stock > 0."""
+    """Notify users who favorited this product if stock > 0.
+    Only queues the fan-out; restock_notifier sends in the background."""
     try:
-        product = db.get_product(product_id)
-        if not product or product["stock"] <= 0: return
-        
-        users_to_notify = db.get_product_favorites(product_id)
-        if not users_to_notify: return
-        
-        price = product["price_usd"]
-        stock = product["stock"]
-        
-        from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-        import strings
-        
-        for user_id in users_to_notify:
-            # Check silent ban!
-            if db.is_banned(user_id):
-                continue
-                
-            lang = db.get_user_language(user_id) or "en"
-            s = strings.STRINGS[lang]
-            title = product["title_ru"] if lang == "ru" else product["title_en"]
-            
-            msg = s["restock_notification"].format(
-                name=title,
-                price=f"{price:.2f}",
-                stock=stock
-            )
-            
-            kb = [[InlineKeyboardButton(s["buy_from_restock"], callback_data=f"buy_{product_id}")]]
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=msg,
-                    reply_markup=InlineKeyboardMarkup(kb),
-                    parse_mode='HTML'
-                )
-            except Exception as e:
-                print(f"[RESTOCK NOTIFY] Failed for {user_id}: {e}")
-                
+        restock_notifier.notify_restock(context.bot, product_id)
     except Exception as e:
-        print(f"[ERROR] trigger_restock_notifications: {e}")
+        logger.error(f"[ERROR] trigger_restock_notifications: {e}")
 
 async def stock_qty_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle quantity input."""
@@ -682,21 +654,31 @@ async def stock_qty_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
         context.user_data.clear()
         return ConversationHandler.END
         
+    product_id = context.user_data['stock_product_id']
+    delivery_type = context.user_data['stock_delivery_type']
     try:
-        qty = int(text)
-        if qty <= 0:
-            await update.message.reply_text("❌ Quantity must be positive.")
-            return STOCK_ENTER_QTY
-            
-        product_id = context.user_data['stock_product_id']
-        delivery_type = context.user_data['stock_delivery_type']
+        # Link/file stock is a counter on the pooled asset row; ∞ = unlimited (NULL units)
+        if delivery_type in ['link', 'file'] and text.strip().lower() in ('∞', 'unlimited', 'inf'):
+            qty = None
+        else:
+            qty = int(text)
+            if qty <= 0:
+                await update.message.reply_text("❌ Quantity must be positive.")
+                return STOCK_ENTER_QTY
         
-        print(f"[ADMIN STOCK] step=enter_qty qty={qty} product_id={product_id}")
+        logger.info(f"[ADMIN STOCK] step=enter_qty qty={qty} product_id={product_id}")
         
         # If Link or File -> Update immediately
         if delivery_type in ['link', 'file']:
-            was_zero = db.increment_stock(product_id, qty)
-            await update.message.reply_text(f"✅ Stock updated successfully (+{qty})!")
+            was_zero = db.add_product_units(product_id, qty)
+            if was_zero is None:
+                await update.message.reply_text(
+                    "❌ This product has no link/file to count yet. Upload one via ➕ Add Product/Stock first."
+                )
+                context.user_data.clear()
+                return ConversationHandler.END
+            added = "unlimited" if qty is None else f"+{qty}"
+            await update.message.reply_text(f"✅ Stock updated successfully ({added})!")
             if was_zero:
                 await trigger_restock_notifications(product_id, context)
             context.user_data.clear()
@@ -711,12 +693,9 @@ async def stock_qty_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return STOCK_ENTER_CODES
         
-        # Unknown type fallback
+        # Unknown type: nothing in stock_items can carry its stock
         else:
-            was_zero = db.increment_stock(product_id, qty)
-            await update.message.reply_text(f"✅ Stock updated successfully (+{qty})!")
-            if was_zero:
-                await trigger_restock_notifications(product_id, context)
+            await update.message.reply_text(f"❌ Cannot add stock for delivery type '{delivery_type}'.")
             context.user_data.clear()
             return ConversationHandler.END
             
@@ -740,7 +719,7 @@ async def stock_codes_received(update: Update, context: ContextTypes.DEFAULT_TYP
     expected_qty = context.user_data['stock_add_qty']
     product_id = context.user_data['stock_product_id']
     
-    print(f"[ADMIN STOCK] step=enter_codes count={len(codes)} expected={expected_qty}")
+    logger.info(f"[ADMIN STOCK] step=enter_codes count={len(codes)} expected={expected_qty}")
     
     if len(codes) != expected_qty:
         await update.message.reply_text(
@@ -751,14 +730,17 @@ async def stock_codes_received(update: Update, context: ContextTypes.DEFAULT_TYP
         
     # Save codes and update stock
     try:
-        db.add_codes_bulk(product_id, codes)
-        was_zero = db.increment_stock(product_id, expected_qty)
+        added = db.add_codes_bulk(product_id, codes)
+        was_zero = db.increment_stock(product_id, added)
         
-        await update.message.reply_text(f"✅ Added {len(codes)} codes and updated stock!")
+        msg = f"✅ Added {added} codes and updated stock!"
+        if added < len(codes):
+            msg += f"\n♻️ Skipped {len(codes) - added} duplicate codes."
+        await update.message.reply_text(msg)
         if was_zero:
             await trigger_restock_notifications(product_id, context)
     except Exception as e:
-        print(f"Error adding codes: {e}")
+        logger.error(f"Error adding codes: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
         
     context.user_data.clear()
@@ -832,7 +814,7 @@ async def codes_add_new_received(update: Update, context: ContextTypes.DEFAULT_T
 async def show_recent_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show recent orders."""
     user = update.effective_user
-    print(f"[ADMIN] recent_orders clicked by user_id={user.id}")
+    logger.info(f"[ADMIN] recent_orders clicked by user_id={user.id}")
     
     # Permission check for extra safety
     if not is_admin(user):
@@ -866,6 +848,7 @@ async def show_recent_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
             if status == 'delivered': status_text = "✅ DELIVERED"
             elif status == 'paid': status_text = "✅ PAID"
+            elif status == 'delivering': status_text = "🚚 DELIVERING"
             elif status == 'pending': status_text = "⏳ AWAITING PAYMENT"
             elif status in ['canceled', 'expired']: status_text = "❌"
             else: status_text = f"❓ {status.upper()}"
@@ -907,7 +890,7 @@ async def show_recent_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
     except Exception as e:
         error_msg = f"Error in recent_orders: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
+        logger.error(error_msg)
         await update.message.reply_text(f"❌ Error fetching orders: {str(e)}")
 
 # ============================================================================
@@ -947,57 +930,37 @@ async def admin_publish_stock_callback(update: Update, context: ContextTypes.DEF
         if str(check).strip() == "1":
             await query.message.reply_text("✅ Stock update published & VERIFIED!")
             
-             # BROADCAST LOGIC
-            status_msg = await query.message.reply_text("🚀 Starting BROADCAST (Push)...")
-            
-            users = db.get_all_users()
-            sent_count = 0
-            fail_count = 0
-            ban_skip = 0
-            total_db = len(users)
-            
-            # Use background task logic conceptually, but run here for simplicity as user requested
-            for i, u in enumerate(users):
-                try:
-                    uid = u['user_id']
-                    
-                    # Skip banned users silently — no broadcast for them
-                    if db.is_banned(uid):
-                        ban_skip += 1
-                        continue
-                    
-                    ulang = u.get('language')
-                    text = msg_ru if ulang == 'ru' else msg_en
-                    
-                    await context.bot.send_message(chat_id=uid, text=text, parse_mode='HTML')
-                    sent_count += 1
-                except Exception:
-                    # Likely blocked by user
-                    fail_count += 1
-                
-                # Rate limit safety: sleep every 25 messages for 1 sec
-                if (i + 1) % 25 == 0:
-                    await asyncio.sleep(1.0)
-            
-            final_report = (
-                f"✅ <b>Broadcast Completed!</b>\n"
-                f"• Sent: {sent_count}\n"
-                f"• Failed: {fail_count} (Blocked/Deleted)\n"
-                f"• Banned (skipped): {ban_skip}\n"
-                f"• Total DB Users: {total_db}"
-            )
-            
-            # Reply to admin
-            await context.bot.send_message(chat_id=user_id, text=final_report, parse_mode='HTML')
+            # BROADCAST: persisted background job, progress is edited into its status message
+            job_id = await broadcast.create_and_start(context.bot, msg_ru, msg_en, query.message.chat_id, user_id)
+            logger.info(f"[STOCK_UPDATE] broadcast job {job_id} started by admin_id={user_id}")
             
         else:
             await query.message.reply_text(f"⚠️ Published but verification failed. Value: {check}")
             
-        print(f"[STOCK_UPDATE] published by admin_id={user_id} verified={check}")
+        logger.info(f"[STOCK_UPDATE] published by admin_id={user_id} verified={check}")
     except Exception as e:
-        print(f"FAILED TO PUBLISH STOCK UPDATE: {e}")
+        logger.error(f"FAILED TO PUBLISH STOCK UPDATE: {e}")
         await query.message.reply_text(f"❌ Error publishing: {str(e)}")
 
+async def broadcast_control_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pause / resume / cancel a broadcast job from its status message."""
+    query = update.callback_query
+    if not is_admin(query.from_user):
+        await query.answer("❌ Not authorized.")
+        return
+
+    action, job_id = query.data.split(":")
+    job_id = int(job_id)
+    actions = {
+        "bcast_pause": (broadcast.pause, "⏸ Paused"),
+        "bcast_resume": (broadcast.resume, "▶️ Resumed"),
+        "bcast_cancel": (broadcast.cancel, "✖️ Canceled"),
+    }
+    handler, done_text = actions[action]
+    job = await handler(context.bot, job_id)
+    await query.answer(done_text if job else "Job is not in a state that allows this.")
+    logger.info(f"[BROADCAST] {action} job {job_id} by admin_id={query.from_user.id} applied={bool(job)}")
+
 async def admin_hide_stock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -1005,7 +968,7 @@ async def admin_hide_stock_callback(update: Update, context: ContextTypes.DEFAUL
     db.set_setting("stock_update_enabled", "0")
     
     await query.message.reply_text("🛑 Stock update hidden. / Обновление скрыто.")
-    print(f"[STOCK_UPDATE] hidden by admin_id={query.from_user.id}")
+    logger.info(f"[STOCK_UPDATE] hidden by admin_id={query.from_user.id}")
 
 async def debug_stock_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Debug command to check current settings state."""
@@ -1022,10 +985,73 @@ async def debug_stock_settings(update: Update, context: ContextTypes.DEFAULT_TYP
     )
     await update.message.reply_text(msg, parse_mode='HTML')
 
+async def show_stuck_deliveries(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show delivery outbox rows that keep failing or were dead-lettered."""
+    if not is_admin(update.effective_user):
+        await update.message.reply_text("❌ Not authorized.")
+        return
+
+    rows = db.get_stuck_deliveries(limit=20)
+    if not rows:
+        await update.message.reply_text("📮 No stuck deliveries. 👍")
+        return
+
+    msg = "📮 <b>Stuck Deliveries</b>\n\n"
+    kb = []
+    for r in rows:
+        state = "☠️ DEAD" if r['status'] == 'dead' else "🔁 RETRYING"
+        title = r.get('title_en') or "Deleted Product"
+        error = (r.get('last_error') or "")[:80]
+        msg += (
+            f"#{r['order_id']} | {title} | {state} | attempts: {r['attempts']}\n"
+            f"User: <code>{r.get('user_id')}</code>\n"
+            f"Error: <code>{html.escape(error)}</code>\n"
+            "-------------------\n"
+        )
+        if r['status'] != 'sending':
+            kb.append([InlineKeyboardButton(f"🔁 Retry #{r['order_id']} now", callback_data=f"outbox_retry:{r['order_id']}")])
+
+    await update.message.reply_text(
+        msg, parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup(kb) if kb else None
+    )
+
+async def show_perf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/perf: handler latency percentiles from the in-memory ring buffers."""
+    if not is_admin(update.effective_user):
+        await update.message.reply_text("❌ Not authorized.")
+        return
+
+    rows = perf.snapshot()
+    if not rows:
+        await update.message.reply_text("⏱ No handler timings recorded yet.")
+        return
+
+    lines = [f"{'handler':<28} {'n':>5} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7}"]
+    for name, count, p50, p95, p99, worst in rows[:40]:
+        lines.append(
+            f"{name[:28]:<28} {count:>5} {p50 * 1000:>6.0f}m {p95 * 1000:>6.0f}m {p99 * 1000:>6.0f}m {worst * 1000:>6.0f}m"
+        )
+    msg = "⏱ <b>Handler latency</b> (ms, last samples per handler)\n\n<pre>" + html.escape("\n".join(lines)) + "</pre>"
+    await update.message.reply_text(msg, parse_mode='HTML')
+
+async def outbox_retry_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Make a stuck delivery due immediately; the outbox worker picks it up."""
+    query = update.callback_query
+    if not is_admin(query.from_user):
+        await query.answer("❌ Not authorized.")
+        return
+
+    order_id = int(query.data.split(":")[1])
+    if db.outbox_requeue(order_id):
+        await query.answer(f"🔁 Order #{order_id} queued for delivery")
+        logger.info(f"[DELIVERY] Order {order_id} requeued by admin_id={query.from_user.id}")
+    else:
+        await query.answer("Already delivered or being sent.")
+
 async def show_users_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show list of users."""
-    users = db.get_all_users()
-    total = len(users)
+    total = db.count_users()
     
     if total == 0:
         await update.message.reply_text("👥 No users recorded yet.")
@@ -1033,17 +1059,11 @@ async def show_users_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     msg = f"👥 <b>Registered Users: {total}</b>\n\n"
     
-    # Sort: joined_at DESC (if exists), else user_id DESC
-    sorted_users = sorted(users, key=lambda x: str(x.get('joined_at') or '0'), reverse=True)
-    
+    # Newest first (joined_at DESC), only the rows we display are loaded
     limit = 60
     shown = 0
     
-    for u in sorted_users:
-        if shown >= limit:
-            msg += f"\n... and {total - shown} more."
-            break
-            
+    for u in db.get_newest_users(limit):
         uid = u['user_id']
         uname = u.get('username')
         joined = u.get('joined_at')
@@ -1058,6 +1078,9 @@ async def show_users_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         
         msg += f"{shown+1}. {user_ref} | ID: <code>{uid}</code> | {date_str}\n"
         shown += 1
+    
+    if total > shown:
+        msg += f"\n... and {total - shown} more."
         
     msg += "\nℹ️ <i>Usernames update automatically when users interact.</i>"
     await update.message.reply_text(msg, parse_mode='HTML')
@@ -0,0 +1,48 @@
+"""
+Background archiver for closed orders and sold stock.
+
+Every ARCHIVE_INTERVAL seconds the archiver moves orders that have been
+delivered or canceled for more than database.ARCHIVE_AFTER_DAYS (with their
+sold stock items) into the archive tables, ARCHIVE_BATCH_SIZE rows per
+transaction. It yields between batches so a large backlog never holds the
+write lock for long.
+"""
+import asyncio
+import logging
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_INTERVAL = 3600.0
+ARCHIVE_BATCH_SIZE = 500
+# Pause between batches so bot writes get the lock in between
+ARCHIVE_BATCH_PAUSE = 0.5
+
+
+async def _drain(archive_batch):
+    total = 0
+    while True:
+        moved = await asyncio.to_thread(archive_batch, limit=ARCHIVE_BATCH_SIZE)
+        total += moved
+        if moved < ARCHIVE_BATCH_SIZE:
+            return total
+        await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+
+
+async def archive_once():
+    """Archive everything currently eligible. Returns (orders, orphan stock items)."""
+    orders = await _drain(db.archive_closed_orders)
+    stock = await _drain(db.archive_orphan_sold_stock)
+    if orders or stock:
+        logger.info(f"[ARCHIVE] Moved {orders} closed orders and {stock} orphan sold stock items to archive")
+    return orders, stock
+
+
+async def archive_loop():
+    while True:
+        try:
+            await archive_once()
+        except Exception as e:
+            logger.error(f"[ARCHIVE] Archiver error: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
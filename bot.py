@@ -11,18 +11,26 @@ from crypto_pay import create_invoice
 import admin_handlers
 
 import delivery_service
+import broadcast
+import order_expiry
+import archiver
+import metrics
+import log_pipeline
+import perf
+import loop_monitor
+import telegram_webhook
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "").lower()
 
 load_dotenv()
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Enable logging (JSON lines via a background thread, rotated logs/bot.log)
+log_pipeline.setup("bot")
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Port for the bot process's Prometheus /metrics endpoint (0 = disabled)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
 # Keyboards
 LANG_KEYBOARD = InlineKeyboardMarkup([
@@ -87,9 +95,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     
                 if stock_msg:
                     await update.message.reply_text(stock_msg, parse_mode='HTML')
-                    print(f"[STOCK_UPDATE] shown to user_id={user.id} in /start")
+                    logger.info(f"[STOCK_UPDATE_SHOWN] user_id={user.id} in /start")
         except Exception as e:
-            print(f"Error sending stock update: {e}")
+            logger.error(f"Error sending stock update: {e}")
     else:
         # First time user, ask for language
         await update.message.reply_text(
@@ -311,7 +319,7 @@ async def profile_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             return
         msg = f"🛒 <b>{'Мои покупки' if lang == 'ru' else 'My purchases'}:</b>\n\n"
         for i, o in enumerate(orders[:20], 1):
-            status_icon = "✅" if o.get('status') in ('paid', 'delivered') else "⏳"
+            status_icon = "✅" if o.get('status') in ('paid', 'delivering', 'delivered') else "⏳"
             amount = o.get('price_usd', 0)
             date = str(o.get('created_at', ''))[:10]
             msg += f"{i}. {status_icon} ${amount} — {date}\n"
@@ -376,12 +384,11 @@ async def topup_check_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             invoice = result["result"]["items"][0]
             if invoice.get("status") == "paid":
                 import datetime as dt
-                amount = topup['amount']
                 
-                # Update topup status (prevents double-credit)
-                updated = db.update_topup_status(invoice_id, 'paid', dt.datetime.now().isoformat())
-                if updated:
-                    new_balance = db.add_user_balance(user_id, amount)
+                # The webhook may be crediting this invoice right now; only one credit commits
+                credited = db.credit_paid_topup(invoice_id, dt.datetime.now().isoformat())
+                if credited:
+                    _, amount, new_balance = credited
                     success_msg = s["topup_success"].replace("{amount}", f"{amount:.2f}").replace("{new_balance}", f"{new_balance:.2f}")
                     await query.message.reply_text(success_msg, parse_mode='HTML')
                 else:
@@ -550,16 +557,15 @@ async def _execute_buy_flow(update: Update, context: ContextTypes.DEFAULT_TYPE,
             stock_id = stock_item['stock_id']
             # Create order with stock_id
             order_id = db.create_order(user_id, p_id, 0, price, used_balance=price, need_crypto=0.0, stock_id=stock_id)
-            db.update_order_status(order_id, 'paid')
             
             import datetime as dt
-            db.update_order_payment(order_id, price, "BALANCE", dt.datetime.now().isoformat())
+            db.mark_order_paid(order_id, price, "BALANCE", dt.datetime.now().isoformat())
             
             msg = s["buy_full_balance"].replace("{price}", f"{price:.2f}")
             await query.message.reply_text(msg, parse_mode="HTML")
             
             # Deliver
-            await delivery_service.deliver_order(order_id, context.bot)
+            await delivery_service.deliver_or_schedule(order_id, context.bot)
         else:
             await query.message.reply_text(s["topup_error"])
         return
@@ -603,6 +609,7 @@ async def _execute_buy_flow(update: Update, context: ContextTypes.DEFAULT_TYPE,
             
             # Create Order in DB
             order_id = db.create_order(user_id, p_id, invoice_id, price, used_balance=used_balance, need_crypto=need_crypto, stock_id=stock_id)
+            order_expiry.track(order_id)
             
             if used_balance > 0:
                 msg_text = s["buy_partial_balance"].format(
@@ -814,9 +821,9 @@ async def show_stock(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: s
                 
             if stock_msg:
                  await update.message.reply_text(stock_msg, parse_mode='HTML')
-                 print(f"[STOCK_UPDATE] shown to user_id={update.effective_user.id} lang={lang}")
+                 logger.info(f"[STOCK_UPDATE_SHOWN] user_id={update.effective_user.id} lang={lang}")
     except Exception as e:
-        print(f"Error sending stock update: {e}")
+        logger.error(f"Error sending stock update: {e}")
 
     await _send_all_products_grouped(update, context, lang)
 
@@ -871,32 +878,12 @@ async def cancel_order_callback(update: Update, context: ContextTypes.DEFAULT_TY
     success = db.cancel_order_db(order_id)
     
     if success:
-        # Delete invoice from CryptoBot
-        from crypto_pay import delete_invoice
-        try:
-            delete_invoice(invoice_id)
-        except:
-            pass
+        # Delete invoice from CryptoBot (in the background)
+        order_expiry.delete_invoices_later([invoice_id])
         await query.edit_message_text(f"❌ Order #{order_id} canceled. Stock returned.")
     else:
         await query.edit_message_text("Order already processed or expired.")
 
-async def check_expirations(context: ContextTypes.DEFAULT_TYPE):
-    """Background task to cancel expired orders."""
-    expired_orders = db.get_expired_pending_orders(minutes=15)
-    for order in expired_orders:
-        order_id = order["order_id"]
-        invoice_id = order["invoice_id"]
-        # Cancel logic
-        if db.cancel_order_db(order_id):
-            print(f"Auto-canceled expired order #{order_id}")
-            # Try delete invoice
-            from crypto_pay import delete_invoice
-            try:
-                delete_invoice(invoice_id)
-            except:
-                pass
-
 async def check_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if is_user_banned(update):
         return  # Silent ignore
@@ -914,8 +901,8 @@ async def check_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.message.reply_text("❌ Order not found.")
         return
 
-    if order['status'] == 'paid' or order['status'] == 'delivered':
-        await delivery_service.deliver_order(order_id, context.bot)
+    if order['status'] in ('paid', 'delivering', 'delivered'):
+        await delivery_service.deliver_or_schedule(order_id, context.bot)
         await query.message.reply_text("✅ Payment already confirmed! Check your messages.")
         return
 
@@ -928,7 +915,7 @@ async def check_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     from crypto_pay import get_invoices
     
     try:
-        print(f"Checking invoice {invoice_id} via API...")
+        logger.debug(f"Checking invoice {invoice_id} via API...")
         result = get_invoices(invoice_ids=invoice_id)
         
         is_paid = False
@@ -936,40 +923,45 @@ async def check_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             items = result['result'].get('items', [])
             if items:
                 status = items[0]['status']
-                print(f"Invoice {invoice_id} status: {status}")
+                logger.debug(f"Invoice {invoice_id} status: {status}")
                 if status == 'paid':
                     is_paid = True
         
         if is_paid:
-            if order['status'] == 'pending':
-                db.update_order_status(order_id, 'paid')
+            # pending -> paid compare-and-set; if the webhook won, this is a no-op
+            invoice = items[0]
+            db.mark_order_paid(order_id, invoice.get('amount'), invoice.get('asset'), invoice.get('paid_at'))
+            if db.get_order(order_id)['status'] == 'canceled':
+                await query.message.reply_text("❌ Order was canceled.")
+                return
                 
-            success = await delivery_service.deliver_order(order_id, context.bot)
+            success = await delivery_service.deliver_or_schedule(order_id, context.bot)
             if success:
                 # Edit original message to remove buttons ideally, but replying is safer
                 await query.message.reply_text("✅ Payment confirmed! Delivering...")
             else:
-                await query.message.reply_text("✅ Payment confirmed, but delivery failed. Contact support.")
+                await query.message.reply_text("✅ Payment confirmed, but delivery is delayed. We will retry automatically.")
         else:
             lang = db.get_user_language(order['user_id']) or "en"
             msg = "⏳ Payment not received yet. Please try again." if lang != 'ru' else "⏳ Оплата ещё не поступила. Попробуйте позже."
             await query.message.reply_text(msg)
             
     except Exception as e:
-        print(f"Check payment exception: {e}")
+        logger.error(f"Check payment exception: {e}")
         await query.message.reply_text("❌ Error checking payment status.")
 
 async def post_init(application: Application) -> None:
     # Use create_task on the loop
-    application.create_task(background_expiration_loop())
-
-async def background_expiration_loop():
-    while True:
-        try:
-            await check_expirations(None)
-        except Exception as e:
-            print(f"Expiration task error: {e}")
-        await asyncio.sleep(60)
+    application.create_task(order_expiry.invoice_delete_worker())
+    application.create_task(order_expiry.expiry_loop())
+    application.create_task(delivery_service.delivery_outbox_loop(application.bot))
+    application.create_task(archiver.archive_loop())
+    application.create_task(loop_monitor.monitor_loop())
+    if METRICS_PORT:
+        # The bot has no web app of its own; serve its registry for Prometheus
+        metrics.start_http_server(METRICS_PORT)
+        logger.info(f"[METRICS] Serving /metrics on port {METRICS_PORT}")
+    await broadcast.resume_jobs(application.bot)
 
 async def command_fallback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """End conversation and handle command."""
@@ -983,15 +975,13 @@ async def command_fallback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle errors in the dispatcher."""
-    logger.error(f"Exception while handling an update: {context.error}")
     # Don't crash the bot on individual handler errors
-    import traceback
-    traceback.print_exc()
+    logger.error(f"Exception while handling an update: {context.error}", exc_info=context.error)
 
 def main() -> None:
     """Run the bot."""
     if not BOT_TOKEN:
-        print("Error: TELEGRAM_BOT_TOKEN not found in .env")
+        logger.error("Error: TELEGRAM_BOT_TOKEN not found in .env")
         return
         
     db.init_db()
@@ -1001,7 +991,7 @@ def main() -> None:
     try:
         migrate_stock.run_migration()
     except Exception as e:
-        print(f"Migration error: {e}")
+        logger.error(f"Migration error: {e}")
         
     application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
     
@@ -1047,18 +1037,22 @@ def main() -> None:
     # Recent Orders Handler
     application.add_handler(MessageHandler(filters.Regex("^📊 Recent Orders$"), admin_handlers.show_recent_orders))
     application.add_handler(MessageHandler(filters.Regex("^👥 Users Stats$"), admin_handlers.show_users_stats))
+    application.add_handler(MessageHandler(filters.Regex("^📮 Stuck Deliveries$"), admin_handlers.show_stuck_deliveries))
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("ad", admin_command))
     application.add_handler(CommandHandler("admin", admin_command))  # Alias for /ad
     application.add_handler(CommandHandler("debug_stock", admin_handlers.debug_stock_settings)) # Debug
+    application.add_handler(CommandHandler("perf", admin_handlers.show_perf))
     application.add_handler(CallbackQueryHandler(language_callback, pattern="^lang_"))
     application.add_handler(CallbackQueryHandler(products_flow_callback, pattern="^prod_(cat:|item:|buy:|back_cats|back_items)"))
     application.add_handler(CallbackQueryHandler(product_callback, pattern="^(cat_|prod_|buy_|fav_|back_to_)"))
     application.add_handler(CallbackQueryHandler(cancel_order_callback, pattern="^cancel_"))
     application.add_handler(CallbackQueryHandler(check_pay_callback, pattern="^checkpay:"))
+    application.add_handler(CallbackQueryHandler(admin_handlers.outbox_retry_callback, pattern="^outbox_retry:"))
     application.add_handler(CallbackQueryHandler(admin_handlers.admin_publish_stock_callback, pattern="^admin_publish_stock$"))
     application.add_handler(CallbackQueryHandler(admin_handlers.admin_hide_stock_callback, pattern="^admin_hide_stock$"))
+    application.add_handler(CallbackQueryHandler(admin_handlers.broadcast_control_callback, pattern="^bcast_(pause|resume|cancel):"))
     
     # Reset Catalog handlers
     application.add_handler(MessageHandler(filters.Regex("^🧹 Reset catalog$"), admin_handlers.reset_catalog_prompt))
@@ -1079,12 +1073,20 @@ def main() -> None:
     
     application.add_handler(MessageHandler(filters.TEXT, menu_handler))
 
+    # Time every handler registered above (wraps callbacks; keep this last)
+    perf.instrument(application)
+
     try:
-        print(f"DEBUG: Stock ENBL: {db.get_setting('stock_update_enabled')}")
+        logger.debug(f"Stock ENBL: {db.get_setting('stock_update_enabled')}")
         val_ru = db.get_setting('stock_update_ru')
-        print(f"DEBUG: Stock RU: {str(val_ru)[:30] if val_ru else 'None'}")
+        logger.debug(f"Stock RU: {str(val_ru)[:30] if val_ru else 'None'}")
     except: pass
     
+    if telegram_webhook.enabled():
+        logger.info("Bot is starting in webhook mode...")
+        asyncio.run(telegram_webhook.serve(application))
+        return
+
     logger.info("Bot is starting polling...")
     
     # Drop pending updates to avoid processing stale messages after restart
@@ -1093,11 +1095,6 @@ def main() -> None:
         allowed_updates=Update.ALL_TYPES
     )
 
-async def expiration_task():
-    while True:
-        await check_expirations(None)
-        await asyncio.sleep(60)
-
 if __name__ == "__main__":
     import time as _time
     
@@ -0,0 +1,175 @@
+"""
+Background broadcast engine.
+
+A broadcast is a persisted job (database.broadcast_jobs) that walks the users
+table by user_id in pages. Each page is sent concurrently through the send
+gateway at broadcast priority (so paid deliveries always go first), then the
+cursor and the sent/failed/blocked counters are saved in one UPDATE. A job can
+be paused, resumed or canceled from the admin's status message and continues
+from its cursor after a restart.
+"""
+import asyncio
+import logging
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+import database as db
+import send_gateway
+from send_gateway import PRIORITY_BROADCAST
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 100
+PROGRESS_EDIT_INTERVAL = 3.0
+
+_tasks = {}
+
+
+def _status_text(job):
+    done = job['sent'] + job['failed'] + job['blocked'] + job['skipped']
+    total = max(job['total'], done)
+    percent = (done * 100 // total) if total else 100
+    title = {
+        'running': "🚀 <b>Broadcast in progress</b>",
+        'paused': "⏸ <b>Broadcast paused</b>",
+        'canceled': "✖️ <b>Broadcast canceled</b>",
+        'done': "✅ <b>Broadcast Completed!</b>",
+    }.get(job['status'], job['status'])
+    return (
+        f"{title} (#{job['job_id']})\n"
+        f"Progress: {done}/{total} ({percent}%)\n"
+        f"• Sent: {job['sent']}\n"
+        f"• Failed: {job['failed']}\n"
+        f"• Blocked/Deleted: {job['blocked']}\n"
+        f"• Skipped (banned/unreachable): {job['skipped']}"
+    )
+
+
+def _status_keyboard(job):
+    job_id = job['job_id']
+    if job['status'] == 'running':
+        buttons = [InlineKeyboardButton("⏸ Pause", callback_data=f"bcast_pause:{job_id}")]
+    elif job['status'] == 'paused':
+        buttons = [InlineKeyboardButton("▶️ Resume", callback_data=f"bcast_resume:{job_id}")]
+    else:
+        return None
+    buttons.append(InlineKeyboardButton("✖️ Cancel", callback_data=f"bcast_cancel:{job_id}"))
+    return InlineKeyboardMarkup([buttons])
+
+
+async def update_status_message(bot, job):
+    """Edit the admin's status message to show the job's current progress."""
+    if not job.get('admin_chat_id') or not job.get('status_message_id'):
+        return
+    try:
+        await send_gateway.edit_message_text(
+            bot, job['admin_chat_id'], job['status_message_id'], _status_text(job),
+            parse_mode='HTML', reply_markup=_status_keyboard(job)
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.warning(f"[BROADCAST] Could not edit status of job {job['job_id']}: {e}")
+    except Exception as e:
+        logger.warning(f"[BROADCAST] Could not edit status of job {job['job_id']}: {e}")
+
+
+async def _send_one(bot, user, job):
+    """Send the job text to one user. Returns 'sent', 'blocked' or 'failed'."""
+    text = job['text_ru'] if user['language'] == 'ru' else job['text_en']
+    try:
+        await send_gateway.send_message(bot, user['user_id'], text, priority=PRIORITY_BROADCAST, parse_mode='HTML')
+    except Exception as e:
+        # The gateway already recorded unreachable chats on the user row
+        return 'blocked' if send_gateway.unreachable_reason(e) else 'failed'
+    if user['unreachable_reason']:
+        # Re-probe succeeded: the user is reachable again
+        db.clear_user_unreachable(user['user_id'])
+    return 'sent'
+
+
+async def _run(bot, job_id):
+    job = db.get_broadcast_job(job_id)
+    last_edit = 0.0
+    logger.info(f"[BROADCAST] Job {job_id} running from user_id>{job['cursor_user_id']}")
+
+    while job and job['status'] == 'running':
+        users = db.get_users_page(job['cursor_user_id'], PAGE_SIZE, exclude_banned=True, exclude_unreachable=True)
+        if not users:
+            job = db.transition_broadcast_job(job_id, ('running',), 'done') or db.get_broadcast_job(job_id)
+            break
+
+        results = await asyncio.gather(*(_send_one(bot, u, job) for u in users))
+        job = db.save_broadcast_progress(
+            job_id, users[-1]['user_id'],
+            sent=results.count('sent'), failed=results.count('failed'),
+            blocked=results.count('blocked'), skipped=0
+        )
+
+        if job and time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL:
+            last_edit = time.monotonic()
+            await update_status_message(bot, job)
+
+    if job:
+        logger.info(f"[BROADCAST] Job {job_id} stopped: status={job['status']} sent={job['sent']} "
+              f"failed={job['failed']} blocked={job['blocked']}")
+        await update_status_message(bot, job)
+
+
+def start_job(bot, job_id):
+    """Run a job in the background unless a runner for it is already active."""
+    task = _tasks.get(job_id)
+    if task and not task.done():
+        return task
+    task = asyncio.get_running_loop().create_task(_run(bot, job_id))
+    _tasks[job_id] = task
+    task.add_done_callback(lambda t: _log_task_result(job_id, t))
+    return task
+
+
+def _log_task_result(job_id, task):
+    _tasks.pop(job_id, None)
+    if not task.cancelled() and task.exception():
+        logger.error(f"[BROADCAST] Job {job_id} crashed: {task.exception()}")
+
+
+async def create_and_start(bot, text_ru, text_en, admin_chat_id, created_by):
+    """Persist a job, post its status message to the admin and start sending."""
+    job_id = db.create_broadcast_job(text_ru, text_en, admin_chat_id, created_by)
+    job = db.get_broadcast_job(job_id)
+    msg = await send_gateway.send_message(
+        bot, admin_chat_id, _status_text(job), parse_mode='HTML', reply_markup=_status_keyboard(job)
+    )
+    db.set_broadcast_message(job_id, msg.message_id)
+    start_job(bot, job_id)
+    return job_id
+
+
+async def pause(bot, job_id):
+    job = db.transition_broadcast_job(job_id, ('running',), 'paused')
+    if job:
+        await update_status_message(bot, job)
+    return job
+
+
+async def resume(bot, job_id):
+    job = db.transition_broadcast_job(job_id, ('paused',), 'running')
+    if job:
+        await update_status_message(bot, job)
+        start_job(bot, job_id)
+    return job
+
+
+async def cancel(bot, job_id):
+    job = db.transition_broadcast_job(job_id, ('running', 'paused'), 'canceled')
+    if job:
+        await update_status_message(bot, job)
+    return job
+
+
+async def resume_jobs(bot):
+    """Restart runners for jobs that were running when the process stopped."""
+    for job in db.get_broadcast_jobs('running'):
+        logger.info(f"[BROADCAST] Resuming job {job['job_id']} after restart")
+        start_job(bot, job['job_id'])
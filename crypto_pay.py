@@ -1,18 +1,38 @@
 import os
+import logging
 import requests
 import hashlib
 import hmac
+import time
 from dotenv import load_dotenv
 
+import metrics
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 CRYPTO_PAY_TOKEN = os.getenv("CRYPTO_PAY_API_TOKEN")
 NET = os.getenv("CRYPTO_BOT_NET", "testnet")
 
 BASE_URL = "https://testnet-pay.crypt.bot/api" if NET == "testnet" else "https://pay.crypt.bot/api"
 
+API_SECONDS = metrics.histogram(
+    "cryptopay_request_seconds", "CryptoPay API call latency", ["method", "outcome"]
+)
+
+def _call(http_method, api_method, **kwargs):
+    """Call a CryptoPay API method, timing it by method and outcome (ok, api_error, http_error)."""
+    outcome = "http_error"
+    started = time.perf_counter()
+    try:
+        response = requests.request(http_method, f"{BASE_URL}/{api_method}", headers=get_headers(), **kwargs)
+        outcome = "ok" if response.ok else "api_error"
+        return response
+    finally:
+        API_SECONDS.observe(time.perf_counter() - started, method=api_method, outcome=outcome)
+
 def get_headers():
-    print(f"DEBUG: Token='{CRYPTO_PAY_TOKEN}', Net='{NET}', URL='{BASE_URL}'")
     return {
         "Crypto-Pay-API-Token": CRYPTO_PAY_TOKEN,
         "Content-Type": "application/json"
@@ -20,8 +40,7 @@ def get_headers():
 
 def get_me():
     """Check if app is running."""
-    url = f"{BASE_URL}/getMe"
-    response = requests.get(url, headers=get_headers())
+    response = _call("GET", "getMe")
     return response.json()
 
 def create_invoice(amount, currency="USD", description="Payment", payload=None):
@@ -31,7 +50,6 @@ def create_invoice(amount, currency="USD", description="Payment", payload=None):
     currency: "USD", "EUR", etc.
     payload: string (metadata, max 4kb)
     """
-    url = f"{BASE_URL}/createInvoice"
     # User requested specific assets
     accepted_assets = "USDT,TON,BTC,ETH,LTC,BNB,TRX,USDC"
     
@@ -46,8 +64,8 @@ def create_invoice(amount, currency="USD", description="Payment", payload=None):
         # "allow_comments": False
     }
     
-    response = requests.post(url, json=data, headers=get_headers())
-    print(f"Create Invoice Response: {response.text}")
+    response = _call("POST", "createInvoice", json=data)
+    logger.debug("Create Invoice Response: %s", response.text)
     return response.json()
 
 def check_signature(body_text: str, signature: str) -> bool:
@@ -68,9 +86,8 @@ def delete_invoice(invoice_id: int):
     """
     Delete an invoice.
     """
-    url = f"{BASE_URL}/deleteInvoice"
     data = {"invoice_id": invoice_id}
-    response = requests.post(url, json=data, headers=get_headers())
+    response = _call("POST", "deleteInvoice", json=data)
     return response.json()
 
 def get_invoices(invoice_ids=None, status=None, limit=100, offset=0):
@@ -78,7 +95,6 @@ def get_invoices(invoice_ids=None, status=None, limit=100, offset=0):
     Get invoices of your app.
     invoice_ids: list or comma-separated string of IDs
     """
-    url = f"{BASE_URL}/getInvoices"
     params = {}
     if invoice_ids:
         if isinstance(invoice_ids, list):
@@ -92,6 +108,6 @@ def get_invoices(invoice_ids=None, status=None, limit=100, offset=0):
     params["count"] = limit
     params["offset"] = offset
         
-    response = requests.get(url, params=params, headers=get_headers())
-    print(f"Get Invoices Response: {response.text}")
+    response = _call("GET", "getInvoices", params=params)
+    logger.debug("Get Invoices Response: %s", response.text)
     return response.json()
@@ -1,9 +1,58 @@
 import sqlite3
 import os
+import logging
+import hashlib
+import json
+import time
 import datetime as dt
 
+import metrics
+import sql_trace
+
+logger = logging.getLogger(__name__)
+
 DB_NAME = os.getenv("DB_PATH", "shop.db")
 
+# Users whose chat was unreachable (blocked bot, chat not found) are skipped by
+# fan-outs; after this many days they are tried once more (0 = never re-probe).
+UNREACHABLE_REPROBE_DAYS = float(os.getenv("UNREACHABLE_REPROBE_DAYS", "30"))
+
+# How long an unpaid reservation holds a stock item (longer than the 15 min
+# order expiry, so the expiry job normally releases it first).
+STOCK_RESERVATION_MINUTES = float(os.getenv("STOCK_RESERVATION_MINUTES", "20"))
+
+# A stock item is sellable when it is available or its unpaid hold has expired.
+# Paid holds have reserved_until NULL and never expire.
+_SELLABLE = "(status = 'available' OR (status = 'reserved' AND reserved_until < ?))"
+
+# Duplicate stock is rejected per product ('product') or across the whole shop
+# ('global'), by a unique index on stock_items.content_hash.
+STOCK_DEDUP_SCOPE = os.getenv("STOCK_DEDUP_SCOPE", "product").lower()
+
+# Archived (sold) stock still counts as a duplicate; binds product_id, content_hash
+_ARCHIVED_DUPLICATE = (
+    "EXISTS (SELECT 1 FROM stock_items_archive WHERE content_hash = ?2)"
+    if STOCK_DEDUP_SCOPE == 'global' else
+    "EXISTS (SELECT 1 FROM stock_items_archive WHERE product_id = ?1 AND content_hash = ?2)"
+)
+
+def content_hash(content):
+    """Digest used to detect duplicate stock content (codes, links)."""
+    if content is None:
+        return None
+    return hashlib.sha256(content.encode('utf-8')).digest()
+
+def asset_key(type_str, value):
+    """Identity of a shared delivery asset: a link URL or a file's file_id.
+    (file_unique_id would survive re-uploads better, but pre-asset stock rows
+    only kept file_id, and both paths must key the same way.)"""
+    return content_hash(f"{type_str}:{value}")
+
+# Link/file stock with the same content is one pooled stock row pointing at a
+# delivery_assets row, with `units` left (NULL = unlimited, counted as this).
+UNLIMITED_STOCK = 9999
+_STOCK_UNITS = f"COALESCE(SUM(COALESCE(units, {UNLIMITED_STOCK})), 0)"
+
 def seed_products():
     """Seed some initial products for testing if empty."""
     conn = get_connection()
@@ -28,18 +77,108 @@ def seed_products():
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''', products)
         conn.commit()
-        print("Seeded initial products.")
+        logger.info("Seeded initial products.")
     conn.close()
 
+# ============================================================================
+# QUERY TIMING
+# ============================================================================
+
+QUERY_SECONDS = metrics.histogram(
+    "sqlite_query_seconds", "SQLite statement execution time (count = statements)", ["op"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+QUERY_ERRORS = metrics.counter("sqlite_query_errors_total", "SQLite statements that raised", ["op", "error"])
+_QUERY_OPS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'WITH', 'CREATE', 'ALTER', 'DROP', 'PRAGMA'}
+
+def _query_op(sql):
+    op = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    return op if op in _QUERY_OPS else 'OTHER'
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor that records every execute/executemany in QUERY_SECONDS."""
+
+    def _timed(self, run, sql, *args):
+        op = _query_op(sql)
+        started = time.perf_counter()
+        try:
+            return run(sql, *args)
+        except sqlite3.Error as e:
+            QUERY_ERRORS.inc(op=op, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            QUERY_SECONDS.observe(elapsed, op=op)
+            sql_trace.observe(sql, elapsed)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+class _TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
 def get_connection():
-    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, factory=_TimedConnection)
     conn.row_factory = sqlite3.Row
+    if sql_trace.ENABLED:
+        conn.set_trace_callback(sql_trace.on_statement)
     return conn
 
+def _run_migration(conn, migrate):
+    """Run migrate(cursor) as one transaction, DDL included; roll back and re-raise on failure."""
+    if conn.in_transaction:
+        conn.commit()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        migrate(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def _migrate_reservation_ttl(c):
+    c.execute("ALTER TABLE stock_items ADD COLUMN reserved_until REAL")
+    c.execute("ALTER TABLE stock_items ADD COLUMN reserved_order_id INTEGER")
+    # Attach existing holds to their orders; unpaid ones get a fresh TTL
+    c.execute('''
+        UPDATE stock_items
+        SET reserved_order_id = o.order_id,
+            reserved_until = CASE WHEN o.status = 'pending' THEN ? END
+        FROM orders o
+        WHERE o.stock_id = stock_items.stock_id AND stock_items.status = 'reserved'
+    ''', (time.time() + STOCK_RESERVATION_MINUTES * 60,))
+    # Holds no order points at were left behind by a crash; without an order
+    # they would read as permanent paid holds, so put them back on sale
+    c.execute('''
+        UPDATE stock_items SET status = 'available'
+        WHERE status = 'reserved' AND reserved_order_id IS NULL
+    ''')
+
+def _migrate_content_hash(c):
+    c.execute("ALTER TABLE stock_items ADD COLUMN content_hash BLOB")
+    # Hash the first copy of each product's content; older duplicates stay
+    # unhashed so the unique index can be built over existing data
+    c.execute('''
+        UPDATE stock_items SET content_hash = content_hash(content)
+        WHERE stock_id IN (
+            SELECT MIN(stock_id) FROM stock_items
+            WHERE content IS NOT NULL
+            GROUP BY product_id, content
+        )
+    ''')
+
 def init_db():
     conn = get_connection()
     c = conn.cursor()
     
+    # WAL lets the webhook ingress write while the bot and workers read
+    c.execute('PRAGMA journal_mode=WAL')
+    
     # Users table
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -70,7 +209,7 @@ def init_db():
             user_id INTEGER,
             product_id INTEGER,
             invoice_id INTEGER,
-            status TEXT DEFAULT 'pending', -- 'pending', 'paid', 'delivered', 'canceled'
+            status TEXT DEFAULT 'pending', -- 'pending', 'paid', 'delivering', 'delivered', 'canceled'
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(user_id) REFERENCES users(user_id),
             FOREIGN KEY(product_id) REFERENCES products(product_id)
@@ -89,6 +228,10 @@ def init_db():
             FOREIGN KEY(product_id) REFERENCES products(product_id)
         )
     ''')
+    try:
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_product_code ON codes(product_id, code)')
+    except sqlite3.IntegrityError:
+        logger.warning("[STOCK] Duplicate rows in codes; per-product code uniqueness is off")
     
     # Migrations: Add new columns to orders table safely
     columns_to_add = [
@@ -101,7 +244,8 @@ def init_db():
         ("delivered_filename", "TEXT"),
         ("delivered_at", "TEXT"),
         ("used_balance", "REAL DEFAULT 0"),
-        ("need_crypto", "REAL DEFAULT 0")
+        ("need_crypto", "REAL DEFAULT 0"),
+        ("updated_at", "TEXT")
     ]
     
     for col_name, col_type in columns_to_add:
@@ -162,6 +306,41 @@ def init_db():
     try:
         c.execute("ALTER TABLE orders ADD COLUMN stock_id INTEGER DEFAULT 0")
     except: pass
+    if 'reserved_until' not in _table_columns(c, 'stock_items'):
+        _run_migration(conn, _migrate_reservation_ttl)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_items_sellable ON stock_items(product_id, status, reserved_until)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_items_holds ON stock_items(status, reserved_until)')
+    if 'content_hash' not in _table_columns(c, 'stock_items'):
+        conn.create_function('content_hash', 1, content_hash, deterministic=True)
+        _run_migration(conn, _migrate_content_hash)
+    c.execute('DROP INDEX IF EXISTS idx_stock_items_product_content')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_items_product_hash ON stock_items(product_id, content_hash)')
+    if STOCK_DEDUP_SCOPE == 'global':
+        try:
+            c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_items_global_hash ON stock_items(content_hash)')
+        except sqlite3.IntegrityError:
+            logger.warning("[STOCK] Same content exists under several products; global de-duplication is off")
+    else:
+        c.execute('DROP INDEX IF EXISTS idx_stock_items_global_hash')
+
+    # Shared link/file assets, referenced by stock rows
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_assets (
+            asset_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL, -- 'link', 'file'
+            content TEXT,
+            file_id TEXT,
+            asset_key BLOB NOT NULL UNIQUE,
+            created_at TEXT
+        )
+    ''')
+    if 'refcount' in _table_columns(c, 'delivery_assets'):
+        # Was never kept in step with deletes or archiving; nothing reads it
+        c.execute('ALTER TABLE delivery_assets DROP COLUMN refcount')
+    if 'asset_id' not in _table_columns(c, 'stock_items'):
+        conn.create_function('asset_key', 2, asset_key, deterministic=True)
+        _run_migration(conn, _migrate_asset_stock)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_items_asset ON stock_items(product_id, asset_id, status)')
 
     # Settings table
     c.execute('''
@@ -211,6 +390,13 @@ def init_db():
     try:
         c.execute("ALTER TABLE users ADD COLUMN balance REAL DEFAULT 0.0")
     except: pass
+    # Migration: unreachable chat tracking (set by the send gateway)
+    try:
+        c.execute("ALTER TABLE users ADD COLUMN unreachable_reason TEXT")
+    except: pass
+    try:
+        c.execute("ALTER TABLE users ADD COLUMN unreachable_at TEXT")
+    except: pass
     
     # Favorites table
     c.execute('''
@@ -224,13 +410,122 @@ def init_db():
         )
     ''')
     
+    # Webhook inbox: verified CryptoPay webhooks waiting to be processed.
+    # Timestamps are epoch seconds so queue lag can be computed cheaply.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            update_id INTEGER,
+            update_type TEXT,
+            body TEXT NOT NULL,
+            status TEXT DEFAULT 'pending', -- 'pending', 'processing', 'done', 'failed'
+            attempts INTEGER DEFAULT 0,
+            received_at REAL NOT NULL,
+            available_at REAL NOT NULL,
+            locked_until REAL,
+            processed_at REAL,
+            last_error TEXT
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users(joined_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)')
+    
+    c.execute('CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox(status, available_at)')
+    
+    # CryptoPay redelivers until acknowledged: one inbox row per update_id.
+    # Older databases may hold repeats from before this index; keep the first.
+    c.execute('''
+        DELETE FROM webhook_inbox
+        WHERE update_id IS NOT NULL
+          AND id > (SELECT MIN(id) FROM webhook_inbox w WHERE w.update_id = webhook_inbox.update_id)
+    ''')
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_inbox_update_id
+        ON webhook_inbox(update_id) WHERE update_id IS NOT NULL
+    ''')
+    # Superseded by the inbox index and the order/topup compare-and-set transitions
+    c.execute('DROP TABLE IF EXISTS processed_events')
+    
+    # Delivery outbox: paid orders whose delivery must be (re)attempted.
+    # 'sending' rows hold a lease in next_attempt_at; 'dead' rows need an admin.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_outbox (
+            order_id INTEGER PRIMARY KEY,
+            status TEXT DEFAULT 'pending', -- 'pending', 'sending', 'done', 'dead'
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_delivery_outbox_due ON delivery_outbox(status, next_attempt_at)')
+    
+    # Broadcast jobs: persisted admin broadcasts, resumable from cursor_user_id
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text_ru TEXT NOT NULL,
+            text_en TEXT NOT NULL,
+            status TEXT DEFAULT 'running', -- 'running', 'paused', 'canceled', 'done'
+            cursor_user_id INTEGER DEFAULT 0, -- last user_id processed
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            admin_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_by INTEGER,
+            created_at TEXT NOT NULL,
+            updated_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    
+    # Invoices registry: one row per CryptoPay invoice, routed by primary key
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'invoices'")
+    invoices_existed = c.fetchone() is not None
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS invoices (
+            invoice_id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL, -- 'order', 'topup'
+            ref_id INTEGER NOT NULL, -- orders.order_id or topups.id
+            user_id INTEGER,
+            amount REAL,
+            status TEXT DEFAULT 'pending', -- 'pending', 'paid', 'canceled'
+            created_at TEXT NOT NULL,
+            updated_at TEXT
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices(status, created_at)')
+    if not invoices_existed:
+        # Backfill invoices created before the registry existed
+        c.execute('''
+            INSERT OR IGNORE INTO invoices (invoice_id, kind, ref_id, user_id, amount, status, created_at)
+            SELECT invoice_id, 'topup', id, user_id, amount,
+                   CASE WHEN status = 'paid' THEN 'paid' ELSE 'pending' END, created_at
+            FROM topups WHERE invoice_id IS NOT NULL
+        ''')
+        c.execute('''
+            INSERT OR IGNORE INTO invoices (invoice_id, kind, ref_id, user_id, amount, status, created_at)
+            SELECT invoice_id, 'order', order_id, user_id, need_crypto,
+                   CASE WHEN status IN ('pending', 'canceled') THEN status ELSE 'paid' END,
+                   COALESCE(created_at, CURRENT_TIMESTAMP)
+            FROM orders WHERE invoice_id IS NOT NULL AND invoice_id != 0
+        ''')
+    
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_stock ON orders(stock_id)')
+    _init_archive(c)
+    
     conn.commit()
     conn.close()
     
     # Initialize the ban cache
     _refresh_ban_cache()
     
-    print("Database tables initialized successfully.")
+    logger.info("Database tables initialized successfully.")
 
 # ============================================================================
 # SILENT BAN SYSTEM
@@ -299,6 +594,317 @@ def get_banned_users():
     conn.close()
     return [dict(row) for row in rows]
 
+# ============================================================================
+# WEBHOOK INBOX
+# ============================================================================
+
+def inbox_add(update_id, update_type, body):
+    """Persist a verified webhook body. Returns the inbox row id, or None if
+    this update_id is already in the inbox (a CryptoPay redelivery)."""
+    now = time.time()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        '''INSERT INTO webhook_inbox (update_id, update_type, body, status, received_at, available_at)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT DO NOTHING''',
+        (update_id, update_type, body, 'pending', now, now)
+    )
+    inbox_id = cursor.lastrowid if cursor.rowcount > 0 else None
+    conn.commit()
+    conn.close()
+    return inbox_id
+
+def inbox_claim(lease_seconds=60):
+    """Atomically claim the oldest due inbox row for processing.
+    Rows whose lease expired (worker crashed mid-processing) are claimable again,
+    which gives at-least-once semantics."""
+    now = time.time()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE webhook_inbox
+        SET status = 'processing', attempts = attempts + 1, locked_until = ?
+        WHERE id = (
+            SELECT id FROM webhook_inbox
+            WHERE (status = 'pending' AND available_at <= ?)
+               OR (status = 'processing' AND locked_until < ?)
+            ORDER BY id
+            LIMIT 1
+        )
+        RETURNING *
+    ''', (now + lease_seconds, now, now))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return dict(row) if row else None
+
+def inbox_complete(inbox_id):
+    """Mark an inbox row as processed."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE webhook_inbox SET status = 'done', processed_at = ?, locked_until = NULL WHERE id = ?",
+        (time.time(), inbox_id)
+    )
+    conn.commit()
+    conn.close()
+
+def inbox_fail(inbox_id, error, retry_delay, max_attempts):
+    """Reschedule a failed inbox row, or park it as 'failed' after max_attempts."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE webhook_inbox
+        SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+            available_at = ?, locked_until = NULL, last_error = ?
+        WHERE id = ?
+    ''', (max_attempts, time.time() + retry_delay, str(error)[:500], inbox_id))
+    conn.commit()
+    conn.close()
+
+def inbox_stats():
+    """Queue depth (pending + processing) and the receive time of the oldest waiting row."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT COUNT(*) AS depth, MIN(received_at) AS oldest
+        FROM webhook_inbox
+        WHERE status IN ('pending', 'processing')
+    ''')
+    row = cursor.fetchone()
+    conn.close()
+    return {'depth': row['depth'], 'oldest': row['oldest']}
+
+def inbox_purge(older_than_seconds=7 * 86400):
+    """Delete processed inbox rows older than the retention window."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "DELETE FROM webhook_inbox WHERE status = 'done' AND processed_at < ?",
+        (time.time() - older_than_seconds,)
+    )
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+# ============================================================================
+# DELIVERY OUTBOX
+# ============================================================================
+
+def outbox_begin(order_id, lease_seconds=120):
+    """Create or claim the outbox row of an order for an immediate attempt.
+    Returns the attempt number, or None if the order is already delivered or
+    another worker holds a live lease on it."""
+    now = time.time()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO delivery_outbox (order_id, status, attempts, next_attempt_at, created_at, updated_at)
+        VALUES (?, 'sending', 1, ?, ?, ?)
+        ON CONFLICT(order_id) DO UPDATE
+        SET status = 'sending', attempts = attempts + 1,
+            next_attempt_at = excluded.next_attempt_at, updated_at = excluded.updated_at
+        WHERE delivery_outbox.status IN ('pending', 'dead')
+           OR (delivery_outbox.status = 'sending' AND delivery_outbox.next_attempt_at < ?)
+        RETURNING attempts
+    ''', (order_id, now + lease_seconds, now, now, now))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return row['attempts'] if row else None
+
+def outbox_claim_due(limit=20, lease_seconds=120):
+    """Claim a batch of outbox rows whose retry time has come (or whose lease expired)."""
+    now = time.time()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE delivery_outbox
+        SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?, updated_at = ?
+        WHERE order_id IN (
+            SELECT order_id FROM delivery_outbox
+            WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        )
+        RETURNING *
+    ''', (now + lease_seconds, now, now, limit))
+    rows = [dict(r) for r in cursor.fetchall()]
+    conn.commit()
+    conn.close()
+    return rows
+
+def outbox_done(order_id):
+    """Mark an outbox row as delivered."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE delivery_outbox SET status = 'done', last_error = NULL, updated_at = ? WHERE order_id = ?",
+        (time.time(), order_id)
+    )
+    conn.commit()
+    conn.close()
+
+def outbox_retry(order_id, error, retry_delay, max_attempts):
+    """Schedule the next attempt, or dead-letter the row after max_attempts.
+    Returns the new status."""
+    now = time.time()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE delivery_outbox
+        SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'pending' END,
+            next_attempt_at = ?, last_error = ?, updated_at = ?
+        WHERE order_id = ?
+        RETURNING status
+    ''', (max_attempts, now + retry_delay, str(error)[:500], now, order_id))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return row['status'] if row else None
+
+def outbox_defer(order_id, delay):
+    """Hand a claimed attempt back without counting it (another worker is
+    mid-delivery) and look at the row again after `delay` seconds."""
+    now = time.time()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE delivery_outbox
+        SET status = 'pending', attempts = MAX(attempts - 1, 0), next_attempt_at = ?, updated_at = ?
+        WHERE order_id = ? AND status = 'sending'
+    ''', (now + delay, now, order_id))
+    conn.commit()
+    conn.close()
+
+def outbox_dead(order_id, error):
+    """Dead-letter a row right away (permanent failure, e.g. no stock item)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE delivery_outbox SET status = 'dead', last_error = ?, updated_at = ? WHERE order_id = ?",
+        (str(error)[:500], time.time(), order_id)
+    )
+    conn.commit()
+    conn.close()
+
+def outbox_requeue(order_id):
+    """Admin action: make a stuck or dead row due immediately. Returns True if found."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE delivery_outbox
+        SET status = 'pending', next_attempt_at = ?, updated_at = ?
+        WHERE order_id = ? AND status IN ('pending', 'dead')
+    ''', (time.time(), time.time(), order_id))
+    found = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return found
+
+def get_stuck_deliveries(limit=30):
+    """Outbox rows that failed at least once and are not delivered yet, dead first."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT d.*, o.user_id, o.product_id, p.title_en
+        FROM delivery_outbox d
+        LEFT JOIN orders o ON o.order_id = d.order_id
+        LEFT JOIN products p ON p.product_id = o.product_id
+        WHERE d.status = 'dead' OR (d.status IN ('pending', 'sending') AND d.last_error IS NOT NULL)
+        ORDER BY d.status = 'dead' DESC, d.updated_at DESC
+        LIMIT ?
+    ''', (limit,))
+    rows = [dict(r) for r in cursor.fetchall()]
+    conn.close()
+    return rows
+
+# ============================================================================
+# BROADCAST JOBS
+# ============================================================================
+
+def create_broadcast_job(text_ru, text_en, admin_chat_id, created_by):
+    """Persist a new broadcast job (status 'running'). Banned and unreachable
+    users are never paged, so they are counted as skipped up front.
+    Returns the job id."""
+    reachable, reachable_params = _reachable_clause()
+    conn = get_connection()
+    cursor = conn.cursor()
+    now = dt.datetime.now().isoformat()
+    cursor.execute(f'''
+        INSERT INTO broadcast_jobs (text_ru, text_en, status, total, skipped, admin_chat_id, created_by, created_at, updated_at)
+        VALUES (?, ?, 'running', (SELECT COUNT(*) FROM users),
+                (SELECT COUNT(*) FROM users u
+                 WHERE EXISTS (SELECT 1 FROM bans b WHERE b.user_id = u.user_id) OR NOT {reachable}),
+                ?, ?, ?, ?)
+    ''', (text_ru, text_en, *reachable_params, admin_chat_id, created_by, now, now))
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+def get_broadcast_job(job_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM broadcast_jobs WHERE job_id = ?', (job_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def get_broadcast_jobs(status):
+    """Jobs in a given status, oldest first."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM broadcast_jobs WHERE status = ? ORDER BY job_id', (status,))
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def set_broadcast_message(job_id, message_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE broadcast_jobs SET status_message_id = ? WHERE job_id = ?', (message_id, job_id))
+    conn.commit()
+    conn.close()
+
+def transition_broadcast_job(job_id, expected, new):
+    """Compare-and-set the job status. `expected` is a tuple of allowed current
+    statuses. Returns the updated job or None if it was in another status."""
+    now = dt.datetime.now().isoformat()
+    placeholders = ",".join("?" * len(expected))
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        UPDATE broadcast_jobs
+        SET status = ?, updated_at = ?,
+            finished_at = CASE WHEN ? IN ('done', 'canceled') THEN ? ELSE finished_at END
+        WHERE job_id = ? AND status IN ({placeholders})
+        RETURNING *
+    ''', (new, now, new, now, job_id, *expected))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return dict(row) if row else None
+
+def save_broadcast_progress(job_id, cursor_user_id, sent, failed, blocked, skipped):
+    """Advance the job cursor and add this batch's counters. Returns the job row
+    (so the runner sees pause/cancel requests made meanwhile)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE broadcast_jobs
+        SET cursor_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?,
+            skipped = skipped + ?, updated_at = ?
+        WHERE job_id = ?
+        RETURNING *
+    ''', (cursor_user_id, sent, failed, blocked, skipped, dt.datetime.now().isoformat(), job_id))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return dict(row) if row else None
+
 # ============================================================================
 # USER MANAGEMENT
 # ============================================================================
@@ -320,7 +926,8 @@ def add_user(user_id, language, username=None):
     if row:
         joined = row['joined_at']
         cursor.execute('''
-            UPDATE users SET language = ?, username = ? WHERE user_id = ?
+            UPDATE users SET language = ?, username = ?, unreachable_reason = NULL, unreachable_at = NULL
+            WHERE user_id = ?
         ''', (language, username, user_id))
     else:
         cursor.execute('''
@@ -331,13 +938,46 @@ def add_user(user_id, language, username=None):
     conn.close()
 
 def update_user_name(user_id, username):
-    """Update only the username if it changed or is missing."""
+    """Update only the username if it changed or is missing.
+    The user just wrote to us, so their chat is reachable again."""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('UPDATE users SET username = ? WHERE user_id = ?', (username, user_id))
+    cursor.execute(
+        'UPDATE users SET username = ?, unreachable_reason = NULL, unreachable_at = NULL WHERE user_id = ?',
+        (username, user_id)
+    )
     conn.commit()
     conn.close()
 
+def mark_user_unreachable(user_id, reason):
+    """Record why and when sending to a user's chat failed permanently."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'UPDATE users SET unreachable_reason = ?, unreachable_at = ? WHERE user_id = ?',
+        (reason, dt.datetime.now().isoformat(), user_id)
+    )
+    conn.commit()
+    conn.close()
+
+def clear_user_unreachable(user_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'UPDATE users SET unreachable_reason = NULL, unreachable_at = NULL WHERE user_id = ? AND unreachable_at IS NOT NULL',
+        (user_id,)
+    )
+    conn.commit()
+    conn.close()
+
+def _reachable_clause(alias="u"):
+    """SQL condition (and params) matching users that fan-outs should try:
+    never unreachable, or due for a re-probe."""
+    if UNREACHABLE_REPROBE_DAYS > 0:
+        cutoff = (dt.datetime.now() - dt.timedelta(days=UNREACHABLE_REPROBE_DAYS)).isoformat()
+        return f"({alias}.unreachable_at IS NULL OR {alias}.unreachable_at < ?)", [cutoff]
+    return f"{alias}.unreachable_at IS NULL", []
+
 def add_favorite(user_id, product_id):
     """Add a product to user favorites. Ignore if already exists."""
     import datetime as dt
@@ -362,6 +1002,27 @@ def check_favorite(user_id, product_id) -> bool:
     conn.close()
     return bool(row)
 
+def get_restock_recipients(product_ids):
+    """(user, product) pairs to notify for the given restocked products: users
+    who favorited them and are not banned nor unreachable (unless due for a
+    re-probe). Includes the user's language; ordered by user."""
+    clause, params = _reachable_clause()
+    placeholders = ",".join("?" * len(product_ids))
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT f.user_id, f.product_id, u.language, u.unreachable_reason
+        FROM favorites f
+        LEFT JOIN users u ON u.user_id = f.user_id
+        WHERE f.product_id IN ({placeholders})
+          AND NOT EXISTS (SELECT 1 FROM bans b WHERE b.user_id = f.user_id)
+          AND (u.user_id IS NULL OR {clause})
+        ORDER BY f.user_id, f.product_id
+    ''', [*product_ids] + params)
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
 def get_product_favorites(product_id):
     """Get all user_ids who favorited a specific product."""
     conn = get_connection()
@@ -379,6 +1040,58 @@ def get_all_users():
     conn.close()
     return [dict(row) for row in rows]
 
+def get_users_page(after_user_id=0, limit=500, language=None, exclude_banned=False,
+                   exclude_unreachable=False):
+    """One keyset page of users ordered by user_id, starting after `after_user_id`.
+    Filters are applied in SQL so callers never see rows they would skip."""
+    where = ["u.user_id > ?"]
+    params = [after_user_id]
+    if language:
+        where.append("u.language = ?")
+        params.append(language)
+    if exclude_banned:
+        where.append("NOT EXISTS (SELECT 1 FROM bans b WHERE b.user_id = u.user_id)")
+    if exclude_unreachable:
+        clause, clause_params = _reachable_clause()
+        where.append(clause)
+        params.extend(clause_params)
+    params.append(limit)
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT u.user_id, u.language, u.username, u.joined_at, u.unreachable_reason
+        FROM users u
+        WHERE {" AND ".join(where)}
+        ORDER BY u.user_id
+        LIMIT ?
+    ''', params)
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def count_users(exclude_banned=False):
+    conn = get_connection()
+    cursor = conn.cursor()
+    if exclude_banned:
+        cursor.execute('SELECT COUNT(*) FROM users u WHERE NOT EXISTS (SELECT 1 FROM bans b WHERE b.user_id = u.user_id)')
+    else:
+        cursor.execute('SELECT COUNT(*) FROM users')
+    count = cursor.fetchone()[0]
+    conn.close()
+    return count
+
+def get_newest_users(limit=60):
+    """Most recently joined users (users without joined_at last)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT user_id, language, username, joined_at FROM users ORDER BY joined_at DESC, user_id DESC LIMIT ?',
+        (limit,)
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
 def get_user_language(user_id):
     conn = get_connection()
     cursor = conn.cursor()
@@ -401,7 +1114,7 @@ def get_user_purchases_count(user_id):
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT COUNT(*) as cnt FROM orders WHERE user_id = ? AND status IN ('paid', 'delivered')",
+        "SELECT COUNT(*) as cnt FROM orders_all WHERE user_id = ? AND status IN ('paid', 'delivering', 'delivered')",
         (user_id,)
     )
     row = cursor.fetchone()
@@ -449,35 +1162,50 @@ def deduct_user_balance(user_id, amount):
     return updated
 
 def create_topup(invoice_id, user_id, amount, currency='USD'):
-    """Create a topup record."""
+    """Create a topup record and register its invoice."""
     import datetime as dt
+    now = dt.datetime.now().isoformat()
     conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         'INSERT INTO topups (invoice_id, user_id, amount, currency, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
-        (invoice_id, user_id, amount, currency, 'pending', dt.datetime.now().isoformat())
+        (invoice_id, user_id, amount, currency, 'pending', now)
     )
+    _register_invoice(cursor, invoice_id, 'topup', cursor.lastrowid, user_id, amount, now)
     conn.commit()
     conn.close()
 
-def update_topup_status(invoice_id, status, paid_at=None):
-    """Update topup status. Returns True if updated, False if already in that status."""
+def credit_paid_topup(invoice_id, paid_at):
+    """Mark a topup paid and credit the user's balance in one transaction.
+    Returns (user_id, amount, new_balance), or None if it was already credited."""
     conn = get_connection()
     cursor = conn.cursor()
-    if paid_at:
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
         cursor.execute(
-            'UPDATE topups SET status = ?, paid_at = ? WHERE invoice_id = ? AND status != ?',
-            (status, paid_at, invoice_id, status)
+            "UPDATE topups SET status = 'paid', paid_at = ? WHERE invoice_id = ? AND status != 'paid' RETURNING user_id, amount",
+            (paid_at, invoice_id)
         )
-    else:
+        topup = cursor.fetchone()
+        if not topup:
+            conn.rollback()
+            return None
         cursor.execute(
-            'UPDATE topups SET status = ? WHERE invoice_id = ? AND status != ?',
-            (status, invoice_id, status)
+            "UPDATE invoices SET status = 'paid', updated_at = ? WHERE invoice_id = ?",
+            (dt.datetime.now().isoformat(), invoice_id)
         )
-    updated = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
-    return updated
+        cursor.execute(
+            'UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE user_id = ? RETURNING balance',
+            (topup['amount'], topup['user_id'])
+        )
+        row = cursor.fetchone()
+        conn.commit()
+        return topup['user_id'], topup['amount'], float(row['balance']) if row else topup['amount']
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 def get_topup_by_invoice(invoice_id):
     """Get topup record by CryptoPay invoice_id."""
@@ -488,14 +1216,41 @@ def get_topup_by_invoice(invoice_id):
     conn.close()
     return dict(row) if row else None
 
+# ============================================================================
+# INVOICES REGISTRY
+# ============================================================================
+
+def _register_invoice(cursor, invoice_id, kind, ref_id, user_id, amount, created_at):
+    """Insert a registry row inside the caller's transaction."""
+    cursor.execute(
+        'INSERT OR REPLACE INTO invoices (invoice_id, kind, ref_id, user_id, amount, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (invoice_id, kind, ref_id, user_id, amount, 'pending', created_at)
+    )
+
+def get_invoice(invoice_id):
+    """Get the registry row (kind, ref_id, user_id, amount, status) for an invoice."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM invoices WHERE invoice_id = ?', (invoice_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
 def get_user_orders(user_id, limit=20):
-    """Get orders for a user."""
+    """Get orders for a user (live and archived)."""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        "SELECT * FROM orders WHERE user_id = ? AND status IN ('paid', 'delivered') ORDER BY created_at DESC LIMIT ?",
-        (user_id, limit)
-    )
+    # Limit each side first so a long archive is never sorted as a whole
+    cursor.execute('''
+        SELECT * FROM (
+            SELECT * FROM (SELECT * FROM orders_hot WHERE user_id = ?1 AND status IN ('paid', 'delivering', 'delivered')
+                           ORDER BY created_at DESC LIMIT ?2)
+            UNION ALL
+            SELECT * FROM (SELECT * FROM orders_cold WHERE user_id = ?1 AND status = 'delivered'
+                           ORDER BY created_at DESC LIMIT ?2)
+        )
+        ORDER BY created_at DESC LIMIT ?2
+    ''', (user_id, limit))
     rows = cursor.fetchall()
     conn.close()
     return [dict(r) for r in rows]
@@ -528,13 +1283,13 @@ def get_products(category_id=None, only_active=True):
     conn = get_connection()
     cursor = conn.cursor()
     
-    query = '''
+    query = f'''
         SELECT p.*, 
-               (SELECT COUNT(*) FROM stock_items WHERE product_id = p.product_id AND status='available') as real_stock
+               (SELECT {_STOCK_UNITS} FROM stock_items WHERE product_id = p.product_id AND {_SELLABLE}) as real_stock
         FROM products p
         WHERE 1=1
     '''
-    params = []
+    params = [time.time()]
     
     if only_active:
         query += " AND p.is_active = 1"
@@ -556,12 +1311,12 @@ def get_products(category_id=None, only_active=True):
 def get_product(product_id):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('''
+    cursor.execute(f'''
         SELECT p.*, 
-               (SELECT COUNT(*) FROM stock_items WHERE product_id = p.product_id AND status='available') as real_stock
+               (SELECT {_STOCK_UNITS} FROM stock_items WHERE product_id = p.product_id AND {_SELLABLE}) as real_stock
         FROM products p 
         WHERE p.product_id = ?
-    ''', (product_id,))
+    ''', (time.time(), product_id))
     row = cursor.fetchone()
     conn.close()
     if row:
@@ -600,66 +1355,263 @@ def get_category(category_id):
     return dict(row) if row else None
 
 def add_stock_item(product_id, type_str, content=None, file_id=None):
-    """Add a single stock item."""
+    """Add a single stock item. Returns False if the content is a duplicate."""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO stock_items (product_id, type, content, file_id, status)
-        VALUES (?, ?, ?, ?, 'available')
-    ''', (product_id, type_str, content, file_id))
+    cursor.execute(f'''
+        INSERT INTO stock_items (product_id, content_hash, type, content, file_id, status)
+        SELECT ?1, ?2, ?3, ?4, ?5, 'available'
+        WHERE ?2 IS NULL OR NOT {_ARCHIVED_DUPLICATE}
+        ON CONFLICT DO NOTHING
+    ''', (product_id, content_hash(content), type_str, content, file_id))
+    added = cursor.rowcount > 0
     conn.commit()
     conn.close()
-    return True
+    return added
 
 def add_stock_items_bulk(product_id, type_str, contents_list):
-    """Add multiple stock items (usually codes)."""
+    """Add multiple stock items (usually codes) in one pass.
+    Content already in stock (sold or not, hot or archived) is skipped by the
+    content_hash unique index. Returns (added, duplicates)."""
     conn = get_connection()
     cursor = conn.cursor()
-    data = [(product_id, type_str, c.strip(), None, 'available') for c in contents_list if c.strip()]
-    cursor.executemany('''
-        INSERT INTO stock_items (product_id, type, content, file_id, status)
-        VALUES (?, ?, ?, ?, ?)
+    data = [(product_id, content_hash(c.strip()), type_str, c.strip()) for c in contents_list if c.strip()]
+    cursor.executemany(f'''
+        INSERT INTO stock_items (product_id, content_hash, type, content, status)
+        SELECT ?1, ?2, ?3, ?4, 'available'
+        WHERE NOT {_ARCHIVED_DUPLICATE}
+        ON CONFLICT DO NOTHING
     ''', data)
-    count = cursor.rowcount
+    added = cursor.rowcount
     conn.commit()
     conn.close()
-    return count
+    return added, len(data) - added
+
+def import_stock_chunk(product_id, type_str, contents):
+    """Insert one chunk of an uploaded stock file in a single transaction.
+    Contents already in stock (including earlier rows of the same import)
+    are skipped. Returns the number of rows inserted."""
+    added, _ = add_stock_items_bulk(product_id, type_str, contents)
+    return added
 
 def reserve_stock_item(product_id):
-    """Reserves one stock item for a product and returns it."""
+    """Reserves one stock item for a product and returns it.
+    Items whose unpaid hold expired are claimable again. The hold lasts
+    STOCK_RESERVATION_MINUTES; create_order attaches it to the order."""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT stock_id, type, content, file_id 
-        FROM stock_items 
-        WHERE product_id = ? AND status = 'available' 
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        stock_id = _claim_sellable(cursor, product_id, time.time() + STOCK_RESERVATION_MINUTES * 60)
+        row = None
+        if stock_id:
+            cursor.execute('''
+                SELECT s.stock_id, s.type,
+                       COALESCE(s.content, a.content) AS content, COALESCE(s.file_id, a.file_id) AS file_id
+                FROM stock_items s
+                LEFT JOIN delivery_assets a ON a.asset_id = s.asset_id
+                WHERE s.stock_id = ?
+            ''', (stock_id,))
+            row = cursor.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return dict(row) if row else None
+
+def _claim_sellable(cursor, product_id, reserved_until, order_id=None):
+    """Reserve one sellable unit of a product; returns its stock_id or None.
+    A pooled asset row gives up one unit, split off as its own reserved row
+    so the order has a stock item of its own. Run inside a write transaction."""
+    cursor.execute(f'''
+        SELECT stock_id, units FROM stock_items
+        WHERE product_id = ? AND {_SELLABLE}
         ORDER BY stock_id ASC
         LIMIT 1
-    ''', (product_id,))
+    ''', (product_id, time.time()))
     row = cursor.fetchone()
     if not row:
-        conn.close()
         return None
-        
-    stock_id = row['stock_id']
-    cursor.execute("UPDATE stock_items SET status = 'reserved' WHERE stock_id = ?", (stock_id,))
-    conn.commit()
-    conn.close()
-    return dict(row)
+    if row['units'] == 1:
+        cursor.execute(
+            "UPDATE stock_items SET status = 'reserved', reserved_until = ?, reserved_order_id = ? WHERE stock_id = ?",
+            (reserved_until, order_id, row['stock_id'])
+        )
+        return row['stock_id']
+    if row['units'] is not None:
+        cursor.execute('UPDATE stock_items SET units = units - 1 WHERE stock_id = ?', (row['stock_id'],))
+    cursor.execute('''
+        INSERT INTO stock_items (product_id, type, asset_id, status, reserved_until, reserved_order_id, units)
+        SELECT product_id, type, asset_id, 'reserved', ?, ?, 1 FROM stock_items WHERE stock_id = ?
+    ''', (reserved_until, order_id, row['stock_id']))
+    return cursor.lastrowid
+
+def _upsert_asset(cursor, type_str, content, file_id):
+    """Asset id for a link/file, creating the delivery_assets row on first use."""
+    value = file_id if type_str == 'file' else content
+    cursor.execute('''
+        INSERT INTO delivery_assets (type, content, file_id, asset_key, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(asset_key) DO UPDATE SET asset_key = excluded.asset_key
+        RETURNING asset_id
+    ''', (type_str, content, file_id, asset_key(type_str, value), dt.datetime.now().isoformat()))
+    return cursor.fetchone()['asset_id']
+
+def _add_pool_units(cursor, product_id, type_str, asset_id, units):
+    """Raise (or create) the product's pooled row for an asset. Returns its units (None = unlimited)."""
+    cursor.execute('''
+        SELECT stock_id, units FROM stock_items
+        WHERE product_id = ? AND asset_id = ? AND status = 'available'
+        ORDER BY stock_id ASC LIMIT 1
+    ''', (product_id, asset_id))
+    pool = cursor.fetchone()
+    if not pool:
+        cursor.execute(
+            "INSERT INTO stock_items (product_id, type, asset_id, status, units) VALUES (?, ?, ?, 'available', ?)",
+            (product_id, type_str, asset_id, units)
+        )
+        return units
+    if pool['units'] is None or units is None:
+        cursor.execute('UPDATE stock_items SET units = NULL WHERE stock_id = ?', (pool['stock_id'],))
+        return None
+    cursor.execute('UPDATE stock_items SET units = units + ? WHERE stock_id = ?', (units, pool['stock_id']))
+    return pool['units'] + units
+
+def add_asset_stock(product_id, type_str, content=None, file_id=None, units=1):
+    """Add `units` of link/file stock (None = unlimited). The link or file is
+    stored once in delivery_assets and the product keeps one pooled stock row
+    per asset, so repeated uploads only raise its counter.
+    Returns the pool's units (None if unlimited)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        asset_id = _upsert_asset(cursor, type_str, content, file_id)
+        total = _add_pool_units(cursor, product_id, type_str, asset_id, units)
+        conn.commit()
+        return total
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def add_product_units(product_id, units):
+    """Top up a link/file product by `units` (None = unlimited): raises the
+    counter on its oldest pooled row, or pools the product's own
+    delivery_value if it has no asset stock yet.
+    Returns True if the product was out of stock before, False if not, or
+    None if there is nothing to count (no asset stock and no delivery_value)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute(
+            f'SELECT {_STOCK_UNITS} AS units FROM stock_items WHERE product_id = ? AND {_SELLABLE}',
+            (product_id, time.time())
+        )
+        was_empty = cursor.fetchone()['units'] == 0
+        cursor.execute('''
+            SELECT asset_id, type FROM stock_items
+            WHERE product_id = ? AND asset_id IS NOT NULL AND status = 'available'
+            ORDER BY stock_id ASC LIMIT 1
+        ''', (product_id,))
+        pool = cursor.fetchone()
+        if pool:
+            asset_id, type_str = pool['asset_id'], pool['type']
+        else:
+            cursor.execute('SELECT delivery_type, delivery_value FROM products WHERE product_id = ?', (product_id,))
+            product = cursor.fetchone()
+            if not product or product['delivery_type'] not in ('link', 'file') or not product['delivery_value']:
+                conn.rollback()
+                return None
+            type_str = product['delivery_type']
+            value = product['delivery_value']
+            asset_id = _upsert_asset(cursor, type_str, value if type_str == 'link' else None,
+                                     value if type_str == 'file' else None)
+        _add_pool_units(cursor, product_id, type_str, asset_id, units)
+        conn.commit()
+        return was_empty
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def _migrate_asset_stock(c):
+    """One-off migration: every distinct link/file becomes one delivery asset
+    (keyed like add_asset_stock, so later uploads of it dedupe), and each
+    product's available copies collapse into a single pooled row with a unit
+    counter."""
+    c.execute("ALTER TABLE stock_items ADD COLUMN asset_id INTEGER")
+    c.execute("ALTER TABLE stock_items ADD COLUMN units INTEGER DEFAULT 1")
+    c.execute('''
+        INSERT INTO delivery_assets (type, content, file_id, asset_key, created_at)
+        SELECT type, content, file_id, asset_key(type, CASE type WHEN 'file' THEN file_id ELSE content END), ?
+        FROM stock_items
+        WHERE type IN ('link', 'file') AND (CASE type WHEN 'file' THEN file_id ELSE content END) IS NOT NULL
+        GROUP BY type, CASE type WHEN 'file' THEN file_id ELSE content END
+        ON CONFLICT DO NOTHING
+    ''', (dt.datetime.now().isoformat(),))
+    c.execute('''
+        UPDATE stock_items SET asset_id = a.asset_id, content = NULL, file_id = NULL, content_hash = NULL
+        FROM delivery_assets a
+        WHERE stock_items.type IN ('link', 'file')
+          AND a.asset_key = asset_key(stock_items.type,
+                                      CASE stock_items.type WHEN 'file' THEN stock_items.file_id ELSE stock_items.content END)
+    ''')
+    c.execute('''
+        UPDATE stock_items SET units = g.n
+        FROM (SELECT MIN(stock_id) AS keep, COUNT(*) AS n FROM stock_items
+              WHERE asset_id IS NOT NULL AND status = 'available'
+              GROUP BY product_id, asset_id) g
+        WHERE stock_items.stock_id = g.keep
+    ''')
+    c.execute('''
+        DELETE FROM stock_items
+        WHERE asset_id IS NOT NULL AND status = 'available' AND stock_id NOT IN (
+            SELECT MIN(stock_id) FROM stock_items
+            WHERE asset_id IS NOT NULL AND status = 'available'
+            GROUP BY product_id, asset_id
+        )
+    ''')
 
 def release_stock_item(stock_id):
     """Release a reserved stock item back to available."""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE stock_items SET status = 'available' WHERE stock_id = ?", (stock_id,))
+    cursor.execute(
+        "UPDATE stock_items SET status = 'available', reserved_until = NULL, reserved_order_id = NULL WHERE stock_id = ?",
+        (stock_id,)
+    )
     conn.commit()
     conn.close()
 
+def release_expired_reservations():
+    """Sweep unpaid holds past their TTL back to available. Returns the count.
+    Sellable queries already treat them as available; this just tidies up."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE stock_items
+        SET status = 'available', reserved_until = NULL, reserved_order_id = NULL
+        WHERE status = 'reserved' AND reserved_until < ?
+    ''', (time.time(),))
+    released = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return released
+
 def mark_stock_item_sold(stock_id):
     """Mark a stock item as sold."""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE stock_items SET status = 'sold' WHERE stock_id = ?", (stock_id,))
+    cursor.execute(
+        "UPDATE stock_items SET status = 'sold', reserved_until = NULL WHERE stock_id = ?",
+        (stock_id,)
+    )
     conn.commit()
     conn.close()
 
@@ -667,7 +1619,7 @@ def get_stock_item(stock_id):
     """Get a stock item by its ID."""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM stock_items WHERE stock_id = ?", (stock_id,))
+    cursor.execute("SELECT * FROM stock_items_all WHERE stock_id = ?", (stock_id,))
     row = cursor.fetchone()
     conn.close()
     return dict(row) if row else None
@@ -681,6 +1633,10 @@ def create_order(user_id, product_id, invoice_id, price_usd=0.0, used_balance=0.
         (user_id, product_id, invoice_id, price_usd, 'pending', used_balance, need_crypto, stock_id)
     )
     order_id = cursor.lastrowid
+    if stock_id:
+        cursor.execute('UPDATE stock_items SET reserved_order_id = ? WHERE stock_id = ?', (order_id, stock_id))
+    if invoice_id:
+        _register_invoice(cursor, invoice_id, 'order', order_id, user_id, need_crypto, dt.datetime.now().isoformat())
     conn.commit()
     conn.close()
     return order_id
@@ -710,7 +1666,7 @@ def update_order_payment(order_id, amount, asset, timestamp):
 def get_order_by_invoice(invoice_id):
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM orders WHERE invoice_id = ?', (invoice_id,))
+    cursor.execute('SELECT * FROM orders_all WHERE invoice_id = ?', (invoice_id,))
     row = cursor.fetchone()
     conn.close()
     return row
@@ -740,27 +1696,106 @@ def get_expired_pending_orders(minutes=15):
     conn = get_connection()
     cursor = conn.cursor()
     # SQLite 'datetime' modifier usage
-    cursor.execute(f'''
+    cursor.execute('''
         SELECT * FROM orders 
         WHERE status = 'pending' 
-        AND created_at < datetime('now', '-{minutes} minutes')
-    ''')
+        AND created_at < datetime('now', ?)
+    ''', (f"-{int(minutes)} minutes",))
     rows = cursor.fetchall()
     conn.close()
     return rows
 
+def get_pending_order_deadlines(minutes=15):
+    """(order_id, expiry deadline as epoch seconds) of every pending order."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT order_id, CAST(strftime('%s', created_at) AS INTEGER) + ? AS deadline
+        FROM orders
+        WHERE status = 'pending'
+    ''', (int(minutes) * 60,))
+    rows = cursor.fetchall()
+    conn.close()
+    return [(row['order_id'], row['deadline']) for row in rows]
+
+def cancel_expired_orders(minutes=15, limit=500):
+    """Cancel up to `limit` pending orders older than `minutes` in one transaction.
+    Stock is restored and used balances are refunded with one bulk UPDATE each.
+    Returns the canceled orders (order_id, invoice_id) so invoices can be deleted."""
+    now = dt.datetime.now().isoformat()
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        # pending -> canceled compare-and-set for the whole set of due orders
+        cursor.execute('''
+            UPDATE orders SET status = 'canceled', updated_at = ?
+            WHERE order_id IN (
+                SELECT order_id FROM orders
+                WHERE status = 'pending' AND created_at < datetime('now', ?)
+                ORDER BY created_at
+                LIMIT ?
+            )
+            RETURNING order_id, invoice_id, user_id, used_balance, stock_id
+        ''', (now, f"-{int(minutes)} minutes", limit))
+        canceled = [dict(row) for row in cursor.fetchall()]
+        if not canceled:
+            conn.rollback()
+            return []
+
+        order_ids = json.dumps([o['order_id'] for o in canceled])
+        stock_ids = json.dumps([o['stock_id'] for o in canceled if o['stock_id']])
+        refunds = json.dumps([[o['user_id'], o['used_balance']] for o in canceled if (o['used_balance'] or 0) > 0])
+
+        # Only holds still owned by these orders (an expired hold may have been re-sold)
+        cursor.execute('''
+            UPDATE stock_items SET status = 'available', reserved_until = NULL, reserved_order_id = NULL
+            WHERE stock_id IN (SELECT value FROM json_each(?)) AND status = 'reserved'
+              AND (reserved_order_id IS NULL OR reserved_order_id IN (SELECT value FROM json_each(?)))
+        ''', (stock_ids, order_ids))
+        cursor.execute('''
+            UPDATE users SET balance = COALESCE(balance, 0) + r.amount
+            FROM (
+                SELECT json_extract(value, '$[0]') AS user_id, SUM(json_extract(value, '$[1]')) AS amount
+                FROM json_each(?) GROUP BY 1
+            ) AS r
+            WHERE users.user_id = r.user_id
+        ''', (refunds,))
+        cursor.execute('''
+            UPDATE invoices SET status = 'canceled', updated_at = ?
+            WHERE kind = 'order' AND status = 'pending' AND ref_id IN (SELECT value FROM json_each(?))
+        ''', (now, order_ids))
+        conn.commit()
+        return [{'order_id': o['order_id'], 'invoice_id': o['invoice_id']} for o in canceled]
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 def cancel_order_db(order_id):
     conn = get_connection()
     cursor = conn.cursor()
     # Get order info to restore stock and refund balance
-    cursor.execute('SELECT product_id, status, user_id, used_balance, stock_id FROM orders WHERE order_id = ?', (order_id,))
+    # pending -> canceled as a compare-and-set, so a payment racing in wins or loses cleanly
+    cursor.execute(
+        "UPDATE orders SET status = 'canceled', updated_at = ? WHERE order_id = ? AND status = 'pending' "
+        "RETURNING product_id, user_id, used_balance, stock_id",
+        (dt.datetime.now().isoformat(), order_id)
+    )
     row = cursor.fetchone()
-    if row and row['status'] == 'pending':
-        cursor.execute("UPDATE orders SET status = 'canceled' WHERE order_id = ?", (order_id,))
+    if row:
+        cursor.execute(
+            "UPDATE invoices SET status = 'canceled', updated_at = ? WHERE kind = 'order' AND ref_id = ? AND status = 'pending'",
+            (dt.datetime.now().isoformat(), order_id)
+        )
         # Increase stock back
         stock_id = row['stock_id']
         if stock_id:
-            cursor.execute("UPDATE stock_items SET status = 'available' WHERE stock_id = ?", (stock_id,))
+            cursor.execute('''
+                UPDATE stock_items SET status = 'available', reserved_until = NULL, reserved_order_id = NULL
+                WHERE stock_id = ? AND status = 'reserved' AND (reserved_order_id IS NULL OR reserved_order_id = ?)
+            ''', (stock_id, order_id))
             
         # Refund used_balance back to user
         used_bal = row['used_balance'] or 0
@@ -798,11 +1833,11 @@ def mark_code_as_used(code_id, user_id):
     conn.close()
 
 def add_codes_bulk(product_id, codes_list):
-    """Add multiple codes for a product."""
+    """Add multiple codes for a product, skipping codes it already has."""
     conn = get_connection()
     cursor = conn.cursor()
     codes_data = [(product_id, code.strip()) for code in codes_list if code.strip()]
-    cursor.executemany('INSERT INTO codes (product_id, code) VALUES (?, ?)', codes_data)
+    cursor.executemany('INSERT INTO codes (product_id, code) VALUES (?, ?) ON CONFLICT DO NOTHING', codes_data)
     conn.commit()
     count = cursor.rowcount
     conn.close()
@@ -896,10 +1931,14 @@ def get_recent_orders(limit=20):
         SELECT 
             o.order_id, o.user_id, o.status, o.created_at, o.invoice_id,
             p.title_en, p.price_usd, p.product_id
-        FROM orders o
+        FROM (
+            SELECT * FROM (SELECT * FROM orders_hot ORDER BY order_id DESC LIMIT ?1)
+            UNION ALL
+            SELECT * FROM (SELECT * FROM orders_cold ORDER BY order_id DESC LIMIT ?1)
+        ) o
         LEFT JOIN products p ON o.product_id = p.product_id
         ORDER BY o.order_id DESC
-        LIMIT ?
+        LIMIT ?1
     ''', (limit,))
     rows = cursor.fetchall()
     conn.close()
@@ -909,13 +1948,157 @@ def get_order(order_id):
     """Get single order by ID."""
     conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM orders WHERE order_id = ?', (order_id,))
+    cursor.execute('SELECT * FROM orders_all WHERE order_id = ?', (order_id,))
     row = cursor.fetchone()
     conn.close()
     if row:
         return dict(row)
     return None
 
+def get_delivery_context(order_id):
+    """Everything deliver_order needs in one query: the order row plus its
+    product titles, stock item and the buyer's language.
+    Product/stock fields are None when the row is missing."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT o.*,
+               p.product_id AS product_found, p.title_ru, p.title_en,
+               s.stock_id AS stock_found, s.type AS stock_type,
+               COALESCE(s.content, a.content) AS stock_content,
+               COALESCE(s.file_id, a.file_id) AS stock_file_id,
+               u.language
+        FROM orders o
+        LEFT JOIN products p ON p.product_id = o.product_id
+        LEFT JOIN stock_items s ON s.stock_id = o.stock_id
+        LEFT JOIN delivery_assets a ON a.asset_id = s.asset_id
+        LEFT JOIN users u ON u.user_id = o.user_id
+        WHERE o.order_id = ?
+    ''', (order_id,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def finalize_delivery(order_id, stock_id, type, value, filename, timestamp):
+    """Record a delivery atomically: delivery details, stock item sold and
+    order status 'delivering' -> 'delivered' are committed together or not at all.
+    Returns False if the order was not in 'delivering' (nothing is written)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            UPDATE orders
+            SET delivered_type = ?, delivered_value = ?, delivered_filename = ?, delivered_at = ?,
+                status = 'delivered', updated_at = ?
+            WHERE order_id = ? AND status = 'delivering'
+        ''', (type, value, filename, timestamp, dt.datetime.now().isoformat(), order_id))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            return False
+        cursor.execute("UPDATE stock_items SET status = 'sold', reserved_until = NULL WHERE stock_id = ?", (stock_id,))
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# ============================================================================
+# ORDER STATE MACHINE
+# ============================================================================
+#
+#   pending -> paid -> delivering -> delivered
+#      |                  |
+#      v                  v (send failed, released for a retry)
+#   canceled            paid
+#
+# Every transition is one compare-and-set UPDATE, so concurrent webhook
+# workers and button handlers can race freely: exactly one caller wins.
+
+ORDER_TRANSITIONS = {
+    'pending': ('paid', 'canceled'),
+    'paid': ('delivering',),
+    'delivering': ('delivered', 'paid'),
+}
+
+def transition_order(order_id, expected, new):
+    """Move an order from `expected` to `new` if it is still in `expected`.
+    Returns the updated order row, or None if another caller got there first."""
+    if new not in ORDER_TRANSITIONS.get(expected, ()):
+        raise ValueError(f"Invalid order transition {expected} -> {new}")
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE orders SET status = ?, updated_at = ? WHERE order_id = ? AND status = ? RETURNING *",
+        (new, dt.datetime.now().isoformat(), order_id, expected)
+    )
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return dict(row) if row else None
+
+def mark_order_paid(order_id, amount, asset, paid_at):
+    """pending -> paid together with the payment details and the invoice registry.
+    Returns True only for the caller that applied the payment."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    now = dt.datetime.now().isoformat()
+    cursor.execute('''
+        UPDATE orders
+        SET status = 'paid', paid_amount = ?, paid_asset = ?, paid_at = ?, updated_at = ?
+        WHERE order_id = ? AND status = 'pending'
+        RETURNING invoice_id, product_id, stock_id
+    ''', (amount, asset, paid_at, now, order_id))
+    row = cursor.fetchone()
+    if row and row['stock_id']:
+        _pin_paid_reservation(cursor, order_id, row['product_id'], row['stock_id'])
+    if row and row['invoice_id']:
+        cursor.execute(
+            "UPDATE invoices SET status = 'paid', updated_at = ? WHERE invoice_id = ?",
+            (now, row['invoice_id'])
+        )
+    conn.commit()
+    conn.close()
+    return row is not None
+
+def _pin_paid_reservation(cursor, order_id, product_id, stock_id):
+    """Make a paid order's hold permanent (reserved_until NULL). If the hold
+    expired and the item was claimed by someone else, reserve another sellable
+    item for the order; if there is none, the order keeps a stock_id it does
+    not own and delivery fails to the outbox for an admin to resolve."""
+    cursor.execute('''
+        UPDATE stock_items SET reserved_until = NULL, reserved_order_id = ?
+        WHERE stock_id = ? AND status = 'reserved' AND (reserved_order_id IS NULL OR reserved_order_id = ?)
+    ''', (order_id, stock_id, order_id))
+    if cursor.rowcount:
+        return
+    replacement = _claim_sellable(cursor, product_id, None, order_id)
+    if replacement:
+        cursor.execute('UPDATE orders SET stock_id = ? WHERE order_id = ?', (replacement, order_id))
+        logger.warning(f"[STOCK] Order {order_id} lost expired hold on {stock_id}, re-reserved {replacement}")
+    else:
+        logger.warning(f"[STOCK] Order {order_id} lost expired hold on {stock_id} and no stock is left")
+
+def claim_order_delivery(order_id, stale_after=300):
+    """paid -> delivering. Only the winner of this claim may send anything.
+    A 'delivering' order whose sender died (older than stale_after seconds)
+    can be claimed again. Returns the order row or None."""
+    now = dt.datetime.now()
+    stale = (now - dt.timedelta(seconds=stale_after)).isoformat()
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE orders SET status = 'delivering', updated_at = ?
+        WHERE order_id = ?
+          AND (status = 'paid' OR (status = 'delivering' AND COALESCE(updated_at, '') < ?))
+        RETURNING *
+    ''', (now.isoformat(), order_id, stale))
+    row = cursor.fetchone()
+    conn.commit()
+    conn.close()
+    return dict(row) if row else None
+
 def update_order_status(order_id, status):
     """Update status of an order."""
     conn = get_connection()
@@ -941,3 +2124,116 @@ def get_setting(key):
     row = cursor.fetchone()
     conn.close()
     return row['value'] if row else None
+
+
+# ============================================================================
+# ARCHIVE (cold tables)
+# ============================================================================
+#
+# Delivered/canceled orders closed for ARCHIVE_AFTER_DAYS and the sold stock
+# items they point at are moved to orders_archive / stock_items_archive in
+# small transactions, keeping the hot tables (catalog counts, reservations,
+# expiry scans) small. The *_all views read both sides for history lookups;
+# orders_hot / orders_cold expose the same column list for UNION queries.
+
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+
+_ARCHIVED_TABLES = ('orders', 'stock_items')
+
+def _table_columns(c, table):
+    return [row[1] for row in c.execute(f'PRAGMA table_info({table})')]
+
+def _init_archive(c):
+    """Create/extend the archive tables and rebuild the read views so they
+    follow the live tables' columns after migrations."""
+    for table in _ARCHIVED_TABLES:
+        archive = f'{table}_archive'
+        c.execute(f'CREATE TABLE IF NOT EXISTS {archive} AS SELECT * FROM {table} WHERE 0')
+        archived = set(_table_columns(c, archive))
+        for column in _table_columns(c, table):
+            if column not in archived:
+                c.execute(f'ALTER TABLE {archive} ADD COLUMN {column}')
+
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_archive_id ON orders_archive(order_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_archive_user ON orders_archive(user_id, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_orders_archive_invoice ON orders_archive(invoice_id)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_archive_id ON stock_items_archive(stock_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_archive_hash ON stock_items_archive(product_id, content_hash)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_archive_global_hash ON stock_items_archive(content_hash)')
+
+    for table in _ARCHIVED_TABLES:
+        cols = ', '.join(_table_columns(c, table))
+        c.execute(f'DROP VIEW IF EXISTS {table}_all')
+        c.execute(f'CREATE VIEW {table}_all AS SELECT {cols} FROM {table} UNION ALL SELECT {cols} FROM {table}_archive')
+    cols = ', '.join(_table_columns(c, 'orders'))
+    c.execute('DROP VIEW IF EXISTS orders_hot')
+    c.execute(f'CREATE VIEW orders_hot AS SELECT {cols} FROM orders')
+    c.execute('DROP VIEW IF EXISTS orders_cold')
+    c.execute(f'CREATE VIEW orders_cold AS SELECT {cols} FROM orders_archive')
+
+def _move_rows(cursor, table, key, ids_json):
+    cols = ', '.join(_table_columns(cursor, table))
+    cursor.execute(
+        f'INSERT INTO {table}_archive ({cols}) SELECT {cols} FROM {table} WHERE {key} IN (SELECT value FROM json_each(?))',
+        (ids_json,)
+    )
+    cursor.execute(f'DELETE FROM {table} WHERE {key} IN (SELECT value FROM json_each(?))', (ids_json,))
+
+def archive_closed_orders(days=ARCHIVE_AFTER_DAYS, limit=500):
+    """Move one batch of orders closed (delivered/canceled) for more than
+    `days`, plus their sold stock items, to the archive tables in one
+    transaction. Returns the number of archived orders."""
+    cutoff = (dt.datetime.now() - dt.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT order_id, stock_id FROM orders
+            WHERE status IN ('delivered', 'canceled')
+              AND datetime(COALESCE(updated_at, delivered_at, created_at)) < ?
+            LIMIT ?
+        ''', (cutoff, limit))
+        rows = cursor.fetchall()
+        if rows:
+            _move_rows(cursor, 'orders', 'order_id', json.dumps([r['order_id'] for r in rows]))
+            stock_ids = json.dumps([r['stock_id'] for r in rows if r['stock_id']])
+            cursor.execute('''
+                SELECT json_group_array(stock_id) FROM stock_items
+                WHERE stock_id IN (SELECT value FROM json_each(?)) AND status = 'sold'
+                  AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.stock_id = stock_items.stock_id)
+            ''', (stock_ids,))
+            _move_rows(cursor, 'stock_items', 'stock_id', cursor.fetchone()[0])
+        conn.commit()
+        return len(rows)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def archive_orphan_sold_stock(limit=500):
+    """Move one batch of sold stock items that no live order points at
+    (sold before orders tracked stock_id). Returns the number moved."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT json_group_array(stock_id) FROM (
+                SELECT stock_id FROM stock_items s
+                WHERE status = 'sold' AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.stock_id = s.stock_id)
+                LIMIT ?
+            )
+        ''', (limit,))
+        ids_json = cursor.fetchone()[0]
+        moved = len(json.loads(ids_json))
+        if moved:
+            _move_rows(cursor, 'stock_items', 'stock_id', ids_json)
+        conn.commit()
+        return moved
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -1,38 +1,102 @@
 import database as db
+import asyncio
 import logging
-from datetime import datetime
+import random
+import time
+import metrics
+import send_gateway
+from send_gateway import PRIORITY_DELIVERY
+from datetime import datetime, timezone
+from telegram.error import BadRequest, Forbidden
 
 logger = logging.getLogger(__name__)
 
-async def deliver_order(order_id: int, bot):
+# Delivery outbox retry policy
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE = 30.0
+OUTBOX_RETRY_CAP = 3600.0
+OUTBOX_LEASE_SECONDS = 120
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_POLL_INTERVAL = 10.0
+
+DELIVERIES = metrics.counter("deliveries_total", "Delivery attempts by outcome (delivered, retry, dead)", ["result"])
+CLICK_TO_DELIVERY = metrics.histogram(
+    "order_click_to_delivery_seconds", "Time from order creation (buy click) to delivered goods",
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 900, 1800, 3600)
+)
+
+def _observe_click_to_delivery(order):
+    try:
+        # orders.created_at is SQLite CURRENT_TIMESTAMP, i.e. UTC
+        created = datetime.strptime(order['created_at'][:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return
+    CLICK_TO_DELIVERY.observe(max(0.0, time.time() - created.timestamp()))
+
+class PermanentDeliveryError(Exception):
+    """Delivery can not succeed by retrying (missing order/stock, bot blocked...)."""
+
+class DeliveryInProgress(Exception):
+    """Another worker holds the paid -> delivering claim for this order."""
+
+async def deliver_order(order_id: int, bot, announce: bool = True):
     """
     Deliver product to user and update order status.
     Idempotent: checks if already delivered.
     """
-    print(f"[DELIVERY] Starting delivery for order_id={order_id}")
+    try:
+        return await _deliver(order_id, bot, announce)
+    except Exception as e:
+        logger.error(f"[DELIVERY] Failed to deliver: {e}")
+        return False
+
+async def _deliver(order_id: int, bot, announce: bool = True):
+    """Deliver an order. Returns True when delivered; raises PermanentDeliveryError
+    for failures a retry can not fix and any other exception for transient ones."""
+    logger.info(f"[DELIVERY] Starting delivery for order_id={order_id}")
     
-    order = db.get_order(order_id)
+    # Order, product, stock item and language in a single query
+    order = db.get_delivery_context(order_id)
     if not order:
-        print(f"[DELIVERY] Order {order_id} not found")
-        return False
+        logger.warning(f"[DELIVERY] Order {order_id} not found")
+        raise PermanentDeliveryError(f"order {order_id} not found")
         
     if order['status'] == 'delivered':
-        print(f"[DELIVERY] Order {order_id} already delivered")
+        logger.info(f"[DELIVERY] Order {order_id} already delivered")
         return True
         
-    user_id = order['user_id']
     product_id = order['product_id']
     
-    product = db.get_product(product_id)
-    if not product:
-        print(f"[DELIVERY] Product {product_id} not found")
-        return False
+    if not order['product_found']:
+        logger.warning(f"[DELIVERY] Product {product_id} not found")
+        raise PermanentDeliveryError(f"product {product_id} not found")
         
-    lang = db.get_user_language(user_id) or "en"
-    delivery_type = product['delivery_type']
-    value = product['delivery_value']
+    # paid -> delivering: only the winner of this claim sends anything
+    if not db.claim_order_delivery(order_id):
+        status = (db.get_order(order_id) or {}).get('status')
+        if status == 'delivered':
+            logger.info(f"[DELIVERY] Order {order_id} already delivered")
+            return True
+        if status == 'delivering':
+            logger.info(f"[DELIVERY] Order {order_id} is being delivered by another worker")
+            raise DeliveryInProgress(f"order {order_id} is being delivered")
+        logger.warning(f"[DELIVERY] Order {order_id} is not paid (status={status})")
+        raise PermanentDeliveryError(f"order {order_id} is {status}, not paid")
+    
+    try:
+        return await _send_order(order, bot, announce)
+    except Exception:
+        # Release the claim so a retry can pick the order up again
+        db.transition_order(order_id, 'delivering', 'paid')
+        raise
+
+async def _send_order(order, bot, announce):
+    """Send the goods of a claimed ('delivering') order and finalize it."""
+    order_id = order['order_id']
+    user_id = order['user_id']
+    lang = order['language'] or "en"
     
-    title = product['title_ru'] if lang == 'ru' else product['title_en']
+    title = order['title_ru'] if lang == 'ru' else order['title_en']
     
     # Message templates
     if lang == 'ru':
@@ -44,61 +108,126 @@ async def deliver_order(order_id: int, bot):
         msg_done = "✅ Done! Here is your product:"
         msg_no_code = "⚠️ Sorry, out of stock (no codes). Please contact support."
 
-    # 1. Notify user that delivery started
-    try:
-        await bot.send_message(chat_id=user_id, text=msg_header, parse_mode='HTML')
-    except Exception as e:
-        # Determine if user blocked bot, etc.
-        print(f"[DELIVERY] Failed to send header: {e}")
+    # 1. Notify user that delivery started (first attempt only)
+    if announce:
+        try:
+            await send_gateway.send_message(bot, user_id, msg_header, priority=PRIORITY_DELIVERY, parse_mode='HTML')
+        except Exception as e:
+            # Determine if user blocked bot, etc.
+            logger.error(f"[DELIVERY] Failed to send header: {e}")
 
     try:
         now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         stock_id = order.get('stock_id')
         
         if not stock_id:
-            await bot.send_message(chat_id=user_id, text=msg_no_code)
-            print(f"[DELIVERY] Order {order_id} missing stock_id")
-            return False
+            await send_gateway.send_message(bot, user_id, msg_no_code, priority=PRIORITY_DELIVERY)
+            logger.warning(f"[DELIVERY] Order {order_id} missing stock_id")
+            raise PermanentDeliveryError(f"order {order_id} has no stock item")
             
-        stock_item = db.get_stock_item(stock_id)
-        if not stock_item:
-            await bot.send_message(chat_id=user_id, text=msg_no_code)
-            print(f"[DELIVERY] Stock item {stock_id} NOT FOUND!")
-            return False
+        if not order['stock_found']:
+            await send_gateway.send_message(bot, user_id, msg_no_code, priority=PRIORITY_DELIVERY)
+            logger.error(f"[DELIVERY] Stock item {stock_id} NOT FOUND!")
+            raise PermanentDeliveryError(f"stock item {stock_id} not found")
 
-        delivery_type = stock_item['type']
-        value = stock_item['content']
-        file_id = stock_item['file_id']
+        delivery_type = order['stock_type']
+        value = order['stock_content']
+        file_id = order['stock_file_id']
 
         # 2. Perform Delivery
         if delivery_type == 'link':
-            await bot.send_message(chat_id=user_id, text=f"{msg_done}\n🔗 {value}")
-            db.update_order_delivery(order_id, 'link', value, None, now_str)
+            await send_gateway.send_message(bot, user_id, f"{msg_done}\n🔗 {value}", priority=PRIORITY_DELIVERY)
+            delivered = ('link', value, None)
             
         elif delivery_type == 'file':
-            await bot.send_document(chat_id=user_id, document=file_id, caption=msg_done)
-            db.update_order_delivery(order_id, 'file', file_id, title, now_str)
+            await send_gateway.send_document(bot, user_id, file_id, priority=PRIORITY_DELIVERY, caption=msg_done)
+            delivered = ('file', file_id, title)
             
         elif delivery_type == 'code':
-            await bot.send_message(
-                chat_id=user_id, 
-                text=f"{msg_done}\n\n<code>{value}</code>", 
+            await send_gateway.send_message(
+                bot, user_id,
+                f"{msg_done}\n\n<code>{value}</code>",
+                priority=PRIORITY_DELIVERY,
                 parse_mode='HTML'
             )
-            db.update_order_delivery(order_id, 'code', value, None, now_str)
+            delivered = ('code', value, None)
             
         else:
-             print(f"[DELIVERY] Unknown type {delivery_type}")
-             return False
+             logger.warning(f"[DELIVERY] Unknown type {delivery_type}")
+             raise PermanentDeliveryError(f"unknown delivery type {delivery_type}")
 
-        # 3. Update DB
-        db.mark_stock_item_sold(stock_id)
-        db.update_order_status(order_id, 'delivered')
-        print(f"[DELIVERY] Order {order_id} marked as delivered")
+        # 3. Update DB: delivery details, stock sold and status in one transaction
+        if not db.finalize_delivery(order_id, stock_id, *delivered, now_str):
+            logger.warning(f"[DELIVERY] Order {order_id} lost its delivering claim before finalizing")
+            return False
+        logger.info(f"[DELIVERY] Order {order_id} marked as delivered")
+        _observe_click_to_delivery(order)
         return True
         
+    except (Forbidden, BadRequest) as e:
+        # Bot blocked / chat gone / bad file id: retrying will not help
+        raise PermanentDeliveryError(str(e)) from e
+    except PermanentDeliveryError:
+        raise
     except Exception as e:
-        print(f"[DELIVERY] Failed to deliver: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"[DELIVERY] Failed to deliver: {e}")
+        raise
+
+
+# ============================================================================
+# DELIVERY OUTBOX
+# ============================================================================
+
+def _retry_delay(attempts):
+    """Exponential backoff with jitter: 30s, 60s, 120s... capped at an hour."""
+    delay = min(OUTBOX_RETRY_CAP, OUTBOX_RETRY_BASE * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+async def _attempt(order_id, bot, attempts):
+    """Run one outbox attempt and record its outcome. Returns True if delivered."""
+    try:
+        await _deliver(order_id, bot, announce=attempts == 1)
+    except PermanentDeliveryError as e:
+        DELIVERIES.inc(result="dead")
+        db.outbox_dead(order_id, e)
+        logger.error(f"[DELIVERY] Order {order_id} dead-lettered: {e}")
+        return False
+    except DeliveryInProgress:
+        # Not a failure: look again once the other worker's lease would have run out
+        db.outbox_defer(order_id, OUTBOX_LEASE_SECONDS)
+        return False
+    except Exception as e:
+        DELIVERIES.inc(result="retry")
+        status = db.outbox_retry(order_id, e, _retry_delay(attempts), OUTBOX_MAX_ATTEMPTS)
+        logger.warning(f"[DELIVERY] Order {order_id} attempt {attempts} failed ({e}), now {status}")
         return False
+    DELIVERIES.inc(result="delivered")
+    db.outbox_done(order_id)
+    return True
+
+async def deliver_or_schedule(order_id: int, bot):
+    """
+    Deliver a paid order now, keeping it in the delivery outbox so a failed
+    attempt is retried by the background worker instead of being lost.
+    Returns True if the order is delivered.
+    """
+    attempts = db.outbox_begin(order_id, OUTBOX_LEASE_SECONDS)
+    if attempts is None:
+        # Already delivered, or another worker is sending it right now
+        order = db.get_order(order_id)
+        return bool(order) and order['status'] == 'delivered'
+    return await _attempt(order_id, bot, attempts)
+
+async def delivery_outbox_loop(bot):
+    """Background worker: drain due outbox rows in batches."""
+    while True:
+        try:
+            rows = db.outbox_claim_due(OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS)
+            if rows:
+                logger.info(f"[DELIVERY] Retrying {len(rows)} outbox deliveries")
+                await asyncio.gather(*(_attempt(r['order_id'], bot, r['attempts']) for r in rows))
+                if len(rows) == OUTBOX_BATCH_SIZE:
+                    continue
+        except Exception as e:
+            logger.error(f"[DELIVERY] Outbox worker error: {e}")
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
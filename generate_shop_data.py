@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Deterministic synthetic shop-data generator for benchmarks.
+
+Builds a shop database with the real schema (via database.init_db) and fills
+it with categories, products, stock items, users, orders, topups, invoices,
+favorites and bans. Indexes are dropped for the bulk load and rebuilt from
+their original definitions afterwards, in the same transaction. Everything is derived from a fixed seed and a fixed
+reference time, so the same arguments always produce the same database.
+
+Usage:
+    python3 generate_shop_data.py --db bench.db
+    python3 generate_shop_data.py --db bench.db --users 500000 --stock 2000000
+"""
+import argparse
+import datetime as dt
+import os
+import random
+import sys
+import time
+
+import database as db
+
+DEFAULT_NOW = "2026-01-01 00:00:00"
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+STOCK_STATUSES = (("available", 0.70), ("reserved", 0.05), ("sold", 0.25))
+ORDER_STATUSES = (("pending", 0.05), ("paid", 0.03), ("delivered", 0.72), ("canceled", 0.20))
+LANGUAGES = (("ru", 0.6), ("en", 0.4))
+DELIVERY_TYPES = ("code", "link", "file")
+ASSETS = ("USDT", "TON", "BTC", "ETH", "LTC")
+
+
+def _weighted(rng, choices):
+    roll = rng.random()
+    acc = 0.0
+    for value, weight in choices:
+        acc += weight
+        if roll < acc:
+            return value
+    return choices[-1][0]
+
+
+def _ts_pool(now, rng, max_days, size=65536):
+    """Pre-format a pool of timestamps; strftime per row dominates otherwise."""
+    span = max_days * 86400
+    return [(now - dt.timedelta(seconds=int(rng.random() * span))).strftime(TS_FORMAT) for _ in range(size)]
+
+
+def _pick(rng, seq):
+    return seq[int(rng.random() * len(seq))]
+
+
+def generate(path, categories=20, products=500, stock=600_000, users=200_000,
+             orders=150_000, topups=50_000, favorites=50_000, bans=1_000,
+             seed=42, now=DEFAULT_NOW):
+    """Create `path` and fill it. Returns a dict of table -> inserted rows."""
+    if os.path.exists(path):
+        os.remove(path)
+
+    db.DB_NAME = path
+    db.init_db()
+
+    rng = random.Random(seed)
+    now_dt = dt.datetime.strptime(now, TS_FORMAT)
+    recent = _ts_pool(now_dt, rng, 180)
+    year = _ts_pool(now_dt, rng, 365)
+    counts = {}
+
+    conn = db.get_connection()
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+
+    # Maintaining every index row by row is most of the load time; building
+    # them once over the finished tables is several times faster. Unique ones
+    # are rebuilt too, so a duplicate would still fail the run.
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")
+    indexes = cursor.fetchall()
+    for index in indexes:
+        cursor.execute(f'DROP INDEX "{index["name"]}"')
+
+    # Categories
+    cursor.executemany(
+        "INSERT INTO categories (category_id, name_ru, name_en, sort_order, is_active) VALUES (?, ?, ?, ?, 1)",
+        ((i, f"Категория {i}", f"Category {i}", i) for i in range(1, categories + 1))
+    )
+    counts["categories"] = categories
+
+    # Products
+    product_types = {}
+    product_prices = {}
+    product_rows = []
+    for p_id in range(1, products + 1):
+        d_type = DELIVERY_TYPES[p_id % len(DELIVERY_TYPES)]
+        price = round(rng.uniform(1, 100), 2)
+        product_types[p_id] = d_type
+        product_prices[p_id] = price
+        product_rows.append((
+            p_id, f"Товар {p_id}", f"Product {p_id}", f"Описание {p_id}", f"Description {p_id}",
+            price, 0, d_type, "", rng.randint(1, categories), 1
+        ))
+    cursor.executemany('''
+        INSERT INTO products (product_id, title_ru, title_en, desc_ru, desc_en, price_usd, stock,
+                              delivery_type, delivery_value, category_id, is_active)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', product_rows)
+    counts["products"] = products
+
+    # Stock items: keep the ids of reserved/sold units so orders can point at them
+    reserved_ids = []
+    sold_ids = []
+    stock_products = {}
+    available_per_product = dict.fromkeys(product_types, 0)
+
+    def stock_rows():
+        for s_id in range(1, stock + 1):
+            p_id = 1 + int(rng.random() * products)
+            d_type = product_types[p_id]
+            status = _weighted(rng, STOCK_STATUSES)
+            if status == "reserved":
+                reserved_ids.append(s_id)
+            elif status == "sold":
+                sold_ids.append(s_id)
+            else:
+                available_per_product[p_id] += 1
+            stock_products[s_id] = p_id
+            content = file_id = None
+            if d_type == "code":
+                content = f"KEY-{p_id:05d}-{s_id:08d}-{rng.getrandbits(32):08X}"
+            elif d_type == "link":
+                content = f"https://example.com/dl/{p_id}/{s_id}"
+            else:
+                file_id = f"BQACAgIAAxkBAAI{p_id:06d}{s_id:08d}"
+            yield (s_id, p_id, d_type, content, file_id, status, _pick(rng, recent), db.content_hash(content))
+
+    cursor.executemany('''
+        INSERT INTO stock_items (stock_id, product_id, type, content, file_id, status, created_at, content_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', stock_rows())
+    counts["stock_items"] = stock
+
+    # Users
+    def user_rows():
+        for i in range(users):
+            u_id = 100_000_000 + i
+            balance = round(rng.uniform(0, 50), 2) if rng.random() < 0.3 else 0.0
+            yield (u_id, _weighted(rng, LANGUAGES), f"user{i}", _pick(rng, year), balance)
+
+    cursor.executemany(
+        "INSERT INTO users (user_id, language, username, joined_at, balance) VALUES (?, ?, ?, ?, ?)",
+        user_rows()
+    )
+    counts["users"] = users
+
+    # Orders: delivered orders consume sold units, pending/paid consume reserved ones
+    rng.shuffle(reserved_ids)
+    rng.shuffle(sold_ids)
+
+    def order_rows():
+        for o_id in range(1, orders + 1):
+            status = _weighted(rng, ORDER_STATUSES)
+            if status == "delivered" and sold_ids:
+                stock_id = sold_ids.pop()
+            elif status in ("pending", "paid") and reserved_ids:
+                stock_id = reserved_ids.pop()
+            else:
+                stock_id = 0
+                if status != "canceled":
+                    status = "canceled"
+            p_id = stock_products[stock_id] if stock_id else rng.randint(1, products)
+            price = product_prices[p_id]
+            created = _pick(rng, recent)
+            paid = status in ("paid", "delivered")
+            delivered = status == "delivered"
+            yield (
+                o_id, 100_000_000 + int(rng.random() * users), p_id, 500_000 + o_id, status, created,
+                price, str(price) if paid else None, rng.choice(ASSETS) if paid else None,
+                created if paid else None,
+                product_types[p_id] if delivered else None,
+                f"delivered-{stock_id}" if delivered else None,
+                created if delivered else None,
+                0.0, price, stock_id
+            )
+
+    cursor.executemany('''
+        INSERT INTO orders (order_id, user_id, product_id, invoice_id, status, created_at,
+                            price_usd, paid_amount, paid_asset, paid_at,
+                            delivered_type, delivered_value, delivered_at,
+                            used_balance, need_crypto, stock_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', order_rows())
+    counts["orders"] = orders
+
+    # Reservation holds: pending orders hold until a TTL past the reference
+    # time, paid ones permanently, and reserved units no order owns are
+    # already-expired holds that the shop can sell again
+    now_epoch = now_dt.replace(tzinfo=dt.timezone.utc).timestamp()
+    cursor.execute('''
+        UPDATE stock_items
+        SET reserved_order_id = o.order_id,
+            reserved_until = CASE WHEN o.status = 'pending' THEN ? END
+        FROM orders o
+        WHERE o.stock_id = stock_items.stock_id AND o.status IN ('pending', 'paid')
+    ''', (now_epoch + db.STOCK_RESERVATION_MINUTES * 60,))
+    cursor.execute(
+        "UPDATE stock_items SET reserved_until = ? WHERE status = 'reserved' AND reserved_order_id IS NULL",
+        (now_epoch,)
+    )
+
+    # Topups
+    def topup_rows():
+        for t_id in range(1, topups + 1):
+            status = "paid" if rng.random() < 0.8 else "pending"
+            created = _pick(rng, recent)
+            yield (
+                t_id, 900_000 + t_id, 100_000_000 + int(rng.random() * users),
+                float(rng.choice((5, 10, 20, 50, 100))), "USD", status, created,
+                created if status == "paid" else None
+            )
+
+    cursor.executemany('''
+        INSERT INTO topups (id, invoice_id, user_id, amount, currency, status, created_at, paid_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', topup_rows())
+    counts["topups"] = topups
+
+    # Invoices registry rows for every order and topup invoice
+    cursor.execute('''
+        INSERT INTO invoices (invoice_id, kind, ref_id, user_id, amount, status, created_at)
+        SELECT invoice_id, 'order', order_id, user_id, need_crypto,
+               CASE WHEN status IN ('pending', 'canceled') THEN status ELSE 'paid' END, created_at
+        FROM orders
+    ''')
+    cursor.execute('''
+        INSERT INTO invoices (invoice_id, kind, ref_id, user_id, amount, status, created_at)
+        SELECT invoice_id, 'topup', id, user_id, amount, status, created_at
+        FROM topups
+    ''')
+    counts["invoices"] = orders + topups
+
+    # Favorites (unique per user/product pair)
+    def favorite_rows():
+        seen = set()
+        while len(seen) < min(favorites, users * products):
+            pair = (100_000_000 + int(rng.random() * users), 1 + int(rng.random() * products))
+            if pair in seen:
+                continue
+            seen.add(pair)
+            yield pair + (_pick(rng, recent),)
+
+    cursor.executemany(
+        "INSERT INTO favorites (user_id, product_id, created_at) VALUES (?, ?, ?)",
+        favorite_rows()
+    )
+    counts["favorites"] = min(favorites, users * products)
+
+    # Bans
+    banned = rng.sample(range(users), min(bans, users))
+    cursor.executemany(
+        "INSERT INTO bans (user_id, banned_at) VALUES (?, ?)",
+        ((100_000_000 + i, _pick(rng, year)) for i in banned)
+    )
+    counts["bans"] = len(banned)
+
+    # Keep the legacy products.stock column in line with the available units
+    cursor.executemany(
+        "UPDATE products SET stock = ? WHERE product_id = ?",
+        ((n, p_id) for p_id, n in available_per_product.items())
+    )
+
+    for index in indexes:
+        cursor.execute(index["sql"])
+
+    conn.commit()
+    conn.close()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic shop database.")
+    parser.add_argument("--db", default="bench_shop.db", help="Output database path (overwritten)")
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--stock", type=int, default=600_000)
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--orders", type=int, default=150_000)
+    parser.add_argument("--topups", type=int, default=50_000)
+    parser.add_argument("--favorites", type=int, default=50_000)
+    parser.add_argument("--bans", type=int, default=1_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--now", default=DEFAULT_NOW, help=f"Reference time for timestamps ({TS_FORMAT})")
+    args = parser.parse_args(argv)
+
+    if args.products < 1 or args.categories < 1 or args.users < 1:
+        parser.error("--products, --categories and --users must be at least 1")
+
+    started = time.perf_counter()
+    counts = generate(
+        args.db, categories=args.categories, products=args.products, stock=args.stock,
+        users=args.users, orders=args.orders, topups=args.topups, favorites=args.favorites,
+        bans=args.bans, seed=args.seed, now=args.now
+    )
+    elapsed = time.perf_counter() - started
+
+    total = sum(counts.values())
+    for table, n in counts.items():
+        print(f"{table:>12}: {n}")
+    print(f"Generated {total} rows into {args.db} in {elapsed:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Non-blocking structured logging.
+
+setup() replaces logging.basicConfig() in the long-running processes. Loggers
+only put records on a bounded in-memory queue (QueueHandler); a background
+QueueListener thread formats them as JSON lines and does the file/console
+I/O, so a slow disk or pipe never stalls a handler. If the queue is full the
+record is dropped and counted rather than blocking the caller.
+
+Each line carries ts, level, logger, msg and, when the message starts with a
+"[TAG]" prefix, an "event" field with that tag. Events listed in LOG_SAMPLE
+("EVENT=rate,..." e.g. "STOCK_UPDATE_SHOWN=0.1") are sampled at that rate
+below WARNING; kept lines include "sample_rate" so counts can be scaled back.
+Files rotate at LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old files.
+"""
+import atexit
+import datetime as dt
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+
+import metrics
+
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Also write to stderr (Railway/Procfile); the shell launchers turn this off
+LOG_CONSOLE = os.getenv("LOG_CONSOLE", "1").lower() in ("1", "true", "yes")
+LOG_QUEUE_SIZE = 10000
+DEFAULT_SAMPLING = "STOCK_UPDATE_SHOWN=0.1"
+
+LOG_DROPPED = metrics.counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+
+_EVENT_RE = re.compile(r"^\[([A-Z][A-Z0-9_ ]*)\]")
+_listener = None
+
+
+def _parse_sampling(spec):
+    rates = {}
+    for part in spec.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip().upper()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+def _event(record):
+    if not isinstance(record.msg, str):
+        return None
+    match = _EVENT_RE.match(record.msg)
+    return match.group(1).replace(" ", "_") if match else None
+
+
+class _SamplingFilter(logging.Filter):
+    """Runs on the caller's thread: tags the event and drops sampled-out records."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        record.event = _event(record)
+        rate = self.rates.get(record.event)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        record.sample_rate = rate
+        return random.random() < rate
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Formatting is deferred to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "ts": dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            entry["event"] = event
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is not None:
+            entry["sample_rate"] = sample_rate
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup(name):
+    """Route the root logger through the queue to logs/<name>.log (and stderr)."""
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter()
+    handlers = []
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(LOG_DIR, f"{name}.log"), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    handlers.append(file_handler)
+    if LOG_CONSOLE:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(_SamplingFilter(_parse_sampling(os.getenv("LOG_SAMPLE", DEFAULT_SAMPLING))))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
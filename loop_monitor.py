@@ -0,0 +1,94 @@
+"""
+Event-loop lag monitor.
+
+monitor_loop() is a background task that sleeps LAG_SAMPLE_INTERVAL and
+records how late it woke up in the event_loop_lag_seconds histogram. It also
+stamps a heartbeat that a watchdog thread checks: when the heartbeat is older
+than LOOP_LAG_THRESHOLD_MS the loop is blocked right now, so the watchdog
+captures the loop thread's stack while it is still inside the blocking call
+(a sync db.* or crypto_pay.* call, say). When the loop wakes up again the
+stall is logged once, with its duration and the innermost project frame.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LAG_SAMPLE_INTERVAL = 0.1
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "250")) / 1000
+STACK_DEPTH = 15
+
+LOOP_LAG_SECONDS = metrics.histogram(
+    "event_loop_lag_seconds", "How late the event loop ran a timer scheduled LAG_SAMPLE_INTERVAL ahead",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+LOOP_STALLS = metrics.counter("event_loop_stalls_total", "Loop stalls longer than LOOP_LAG_THRESHOLD", ["culprit"])
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _culprit(frame):
+    """Innermost frame from this project's modules, as 'module.function (file:line)'."""
+    for summary in reversed(traceback.extract_stack(frame)):
+        path = os.path.abspath(summary.filename)
+        if os.path.dirname(path) == _PROJECT_DIR and path != os.path.abspath(__file__):
+            module = os.path.splitext(os.path.basename(path))[0]
+            return f"{module}.{summary.name}", f"{os.path.basename(path)}:{summary.lineno}"
+    return "unknown", "-"
+
+
+class _Watchdog(threading.Thread):
+    """Samples the loop thread's stack while the loop is blocked."""
+
+    def __init__(self, loop_thread_id):
+        super().__init__(name="loop-watchdog", daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.heartbeat = time.monotonic()
+        self.captured = None  # (culprit, location, stack) for the current stall
+
+    def beat(self):
+        self.heartbeat = time.monotonic()
+
+    def run(self):
+        while True:
+            time.sleep(LOOP_LAG_THRESHOLD / 2)
+            blocked_for = time.monotonic() - self.heartbeat - LAG_SAMPLE_INTERVAL
+            if blocked_for < LOOP_LAG_THRESHOLD or self.captured is not None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            culprit, location = _culprit(frame)
+            stack = "".join(traceback.format_stack(frame)[-STACK_DEPTH:])
+            self.captured = (culprit, location, stack)
+
+
+async def monitor_loop():
+    watchdog = _Watchdog(threading.get_ident())
+    watchdog.start()
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LAG_SAMPLE_INTERVAL
+        await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+        lag = max(0.0, loop.time() - expected)
+        watchdog.beat()
+        LOOP_LAG_SECONDS.observe(lag)
+        if lag < LOOP_LAG_THRESHOLD:
+            watchdog.captured = None
+            continue
+        captured, watchdog.captured = watchdog.captured, None
+        if captured is None:
+            # Stall ended between watchdog checks; no stack available
+            LOOP_STALLS.inc(culprit="unknown")
+            logger.warning(f"[LOOP] Event loop blocked for {lag * 1000:.0f} ms (no stack captured)")
+            continue
+        culprit, location, stack = captured
+        LOOP_STALLS.inc(culprit=culprit)
+        logger.warning(f"[LOOP] Event loop blocked for {lag * 1000:.0f} ms in {culprit} ({location})\n{stack}")
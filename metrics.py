@@ -0,0 +1,193 @@
+"""
+In-process metrics registry.
+Counters, gauges and histograms rendered in the Prometheus text format.
+The webhook server serves them on /metrics; other processes (the bot) can
+expose their own registry with start_http_server().
+"""
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self):
+        lines = self._header()
+        with _lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount=1.0, **labels):
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        lines = self._header()
+        with _lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = self._header()
+        with _lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    labels = _format_labels(self.labelnames, key, ("le", repr(float(bound))))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                plain = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{plain} {total}")
+                lines.append(f"{self.name}_count{plain} {count}")
+        return lines
+
+
+def _register(cls, name, documentation, labelnames, **kwargs):
+    with _lock:
+        existing = _registry.get(name)
+        if existing is not None:
+            if not isinstance(existing, cls) or existing.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} already registered with a different type or labels")
+            return existing
+        metric = cls(name, documentation, labelnames, **kwargs)
+        _registry[name] = metric
+        return metric
+
+
+def counter(name, documentation, labelnames=()):
+    """Get or create a counter."""
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    """Get or create a gauge."""
+    return _register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Get or create a histogram."""
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def render() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    with _lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in sorted(metrics, key=lambda m: m.name):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serve /metrics from a daemon thread (for processes without a web app)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -53,21 +53,15 @@ def run_migration():
             migrated_products += 1
             
         elif d_type in ['link', 'file']:
-            # We don't have a list of items, just a stock count and a single value.
-            # We need to replicate the item `base_stock` times.
+            # A single value with a stock count: one shared asset whose pooled
+            # stock row carries the count, instead of `base_stock` copies
             if base_stock > 0:
-                for _ in range(base_stock):
-                    if d_type == 'link':
-                        cursor.execute(
-                            "INSERT INTO stock_items (product_id, type, content, status) VALUES (?, ?, ?, 'available')",
-                            (p_id, 'link', d_val)
-                        )
-                    elif d_type == 'file':
-                        cursor.execute(
-                            "INSERT INTO stock_items (product_id, type, file_id, status) VALUES (?, ?, ?, 'available')",
-                            (p_id, 'file', d_val)
-                        )
-                    migrated_items += 1
+                conn.commit()
+                if d_type == 'link':
+                    db.add_asset_stock(p_id, 'link', content=d_val, units=base_stock)
+                else:
+                    db.add_asset_stock(p_id, 'file', file_id=d_val, units=base_stock)
+                migrated_items += base_stock
                 migrated_products += 1
 
     conn.commit()
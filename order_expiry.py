@@ -0,0 +1,116 @@
+"""
+Deadline-driven expiry of unpaid orders.
+
+Pending order deadlines live in an in-memory heap (rebuilt from the database
+on start). The scheduler sleeps exactly until the earliest deadline, then
+cancels every due order in one set-based transaction
+(database.cancel_expired_orders), sweeps stock holds that outlived their
+reservation TTL, and hands the CryptoPay invoice deletions
+to an async batch queue, so slow HTTP calls never hold up expiry.
+"""
+import asyncio
+import heapq
+import logging
+import time
+
+import database as db
+from crypto_pay import delete_invoice
+
+logger = logging.getLogger(__name__)
+
+ORDER_TTL_MINUTES = 15
+# Safety net: rescan the table this often in case a deadline was missed
+RESYNC_INTERVAL = 300.0
+INVOICE_DELETE_BATCH = 20
+
+_heap = []
+_wakeup = None
+# Created at import (asyncio queues bind to a loop lazily since 3.10) so ids
+# queued before invoice_delete_worker starts wait for it instead of being lost
+_invoice_queue = asyncio.Queue()
+
+
+def track(order_id, deadline=None):
+    """Register a new pending order so it expires exactly at its deadline."""
+    if deadline is None:
+        deadline = time.time() + ORDER_TTL_MINUTES * 60
+    heapq.heappush(_heap, (deadline, order_id))
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def delete_invoices_later(invoice_ids):
+    """Queue CryptoPay invoices for deletion by the batch worker."""
+    for invoice_id in invoice_ids:
+        if invoice_id:
+            _invoice_queue.put_nowait(invoice_id)
+
+
+def _reload():
+    _heap.clear()
+    for order_id, deadline in db.get_pending_order_deadlines(ORDER_TTL_MINUTES):
+        _heap.append((deadline, order_id))
+    heapq.heapify(_heap)
+
+
+def _expire_due():
+    """Cancel everything past its deadline; returns the number of canceled orders."""
+    now = time.time()
+    while _heap and _heap[0][0] <= now:
+        heapq.heappop(_heap)
+
+    total = 0
+    while True:
+        canceled = db.cancel_expired_orders(ORDER_TTL_MINUTES)
+        if not canceled:
+            break
+        total += len(canceled)
+        delete_invoices_later(o['invoice_id'] for o in canceled)
+        logger.info(f"Auto-canceled {len(canceled)} expired orders: {[o['order_id'] for o in canceled]}")
+
+    # Holds whose order is gone or that outlived their TTL; sellable already,
+    # this only resets their status
+    released = db.release_expired_reservations()
+    if released:
+        logger.info(f"[EXPIRY] Released {released} expired stock reservations")
+    return total
+
+
+async def expiry_loop():
+    """Sleep until the next deadline (or a new earlier one), then expire."""
+    global _wakeup
+    _wakeup = asyncio.Event()
+    last_resync = 0.0
+    while True:
+        try:
+            if time.monotonic() - last_resync >= RESYNC_INTERVAL:
+                last_resync = time.monotonic()
+                _reload()
+            _expire_due()
+        except Exception as e:
+            logger.error(f"Expiration task error: {e}")
+
+        timeout = RESYNC_INTERVAL - (time.monotonic() - last_resync)
+        if _heap:
+            # created_at has second resolution; +1s so the SQL cutoff has passed too
+            timeout = min(timeout, _heap[0][0] - time.time() + 1)
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+
+async def invoice_delete_worker():
+    """Delete queued CryptoPay invoices in concurrent batches off the event loop."""
+    while True:
+        batch = [await _invoice_queue.get()]
+        while len(batch) < INVOICE_DELETE_BATCH and not _invoice_queue.empty():
+            batch.append(_invoice_queue.get_nowait())
+        results = await asyncio.gather(
+            *(asyncio.to_thread(delete_invoice, invoice_id) for invoice_id in batch),
+            return_exceptions=True
+        )
+        for invoice_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.warning(f"[EXPIRY] deleteInvoice {invoice_id} failed: {result}")
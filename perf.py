@@ -0,0 +1,123 @@
+"""
+Per-handler latency instrumentation for the bot Application.
+
+python-telegram-bot has no middleware hook, so instrument() wraps the
+callback of every registered handler (including those nested inside
+ConversationHandlers) once all handlers are added. Each invocation is timed
+into the handler_seconds histogram, labelled by handler name and callback
+prefix, and appended to an in-memory ring buffer that the admin /perf
+command summarises as p50/p95/p99. Invocations slower than
+SLOW_HANDLER_SECONDS are logged with their update type. With SQL_TRACE on,
+each invocation is also an sql_trace scope.
+"""
+import functools
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import ConversationHandler
+
+import metrics
+import sql_trace
+
+logger = logging.getLogger(__name__)
+
+SLOW_HANDLER_SECONDS = float(os.getenv("SLOW_HANDLER_MS", "1000")) / 1000
+RING_SIZE = 1000
+
+HANDLER_SECONDS = metrics.histogram("handler_seconds", "Bot handler wall time", ["handler", "prefix"])
+
+_samples = {}
+_samples_lock = threading.Lock()
+_PREFIX_RE = re.compile(r"[A-Za-z]+")
+
+
+def _callback_prefix(update):
+    """Leading word of the callback data ('buy_12' -> 'buy'), or '-'."""
+    query = getattr(update, "callback_query", None)
+    if query is None or not query.data:
+        return "-"
+    match = _PREFIX_RE.match(query.data)
+    return match.group(0) if match else "-"
+
+
+def _update_type(update):
+    if not isinstance(update, Update):
+        return type(update).__name__
+    return next((t for t in Update.ALL_TYPES if getattr(update, t, None) is not None), "unknown")
+
+
+def _record(name, seconds):
+    with _samples_lock:
+        ring = _samples.get(name)
+        if ring is None:
+            ring = _samples[name] = deque(maxlen=RING_SIZE)
+        ring.append(seconds)
+
+
+def _timed(callback):
+    name = getattr(callback, "__name__", None) or repr(callback)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            with sql_trace.scope(name):
+                return await callback(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            prefix = _callback_prefix(update)
+            HANDLER_SECONDS.observe(elapsed, handler=name, prefix=prefix)
+            _record(name, elapsed)
+            if elapsed >= SLOW_HANDLER_SECONDS:
+                logger.warning(f"[PERF] Slow handler {name} ({_update_type(update)}, prefix={prefix}): {elapsed * 1000:.0f} ms")
+
+    wrapper.__perf_wrapped__ = True
+    return wrapper
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for child in nested:
+            _instrument_handler(child)
+        return
+    callback = getattr(handler, "callback", None)
+    if callback is not None and not getattr(callback, "__perf_wrapped__", False):
+        handler.callback = _timed(callback)
+
+
+def instrument(application):
+    """Wrap every handler registered on `application` with timing. Call after
+    all add_handler() calls; handlers added later are not timed."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+def _percentile(ordered, q):
+    # Nearest-rank percentile on an already sorted list
+    index = max(0, min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+def snapshot():
+    """[(handler, samples, p50, p95, p99, max)] in seconds, slowest p95 first."""
+    with _samples_lock:
+        rings = {name: list(ring) for name, ring in _samples.items()}
+    rows = []
+    for name, samples in rings.items():
+        if not samples:
+            continue
+        ordered = sorted(samples)
+        rows.append((name, len(ordered), _percentile(ordered, 0.50), _percentile(ordered, 0.95),
+                     _percentile(ordered, 0.99), ordered[-1]))
+    rows.sort(key=lambda row: row[3], reverse=True)
+    return rows
@@ -0,0 +1,147 @@
+"""
+Restock notification fan-out.
+
+Admin handlers only enqueue a product id and return; a single background
+worker collects restocks for a short coalescing window, loads the
+notifiable favorites of all of them in one query (banned and unreachable
+users are filtered in SQL) and sends each user one message: the classic
+notice for a single product, or a digest with one buy button per product.
+Sends go through the send gateway at broadcast priority, so paid
+deliveries keep precedence.
+"""
+import asyncio
+import logging
+import os
+from itertools import groupby
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import database as db
+import send_gateway
+from send_gateway import PRIORITY_BROADCAST
+from strings import STRINGS
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for more restocks before sending (0 sends right away)
+DIGEST_WINDOW = float(os.getenv("RESTOCK_DIGEST_WINDOW", "15"))
+MAX_DIGEST_ITEMS = 10
+SEND_BATCH_SIZE = 50
+
+_queue = None
+_worker = None
+_loop = None
+
+
+def notify_restock(bot, product_id):
+    """Queue restock notifications for a product. Returns immediately."""
+    global _queue, _worker, _loop
+    loop = asyncio.get_running_loop()
+    if _loop is not loop or _worker is None or _worker.done():
+        _loop = loop
+        _queue = asyncio.Queue()
+        _worker = loop.create_task(_run(bot))
+    _queue.put_nowait(product_id)
+    logger.info(f"[RESTOCK NOTIFY] Queued product {product_id}")
+
+
+async def _collect_window():
+    """Wait for the first restock, then gather everything queued within the window."""
+    product_ids = [await _queue.get()]
+    deadline = asyncio.get_running_loop().time() + DIGEST_WINDOW
+    while True:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            break
+        try:
+            product_id = await asyncio.wait_for(_queue.get(), timeout=remaining)
+        except asyncio.TimeoutError:
+            break
+        if product_id not in product_ids:
+            product_ids.append(product_id)
+    return product_ids
+
+
+async def _run(bot):
+    while True:
+        product_ids = await _collect_window()
+        try:
+            await _fan_out(bot, product_ids)
+        except Exception as e:
+            logger.error(f"[RESTOCK NOTIFY] Fan-out for products {product_ids} failed: {e}")
+
+
+def _single_message(s, lang, product):
+    title = product["title_ru"] if lang == "ru" else product["title_en"]
+    msg = s["restock_notification"].format(
+        name=title,
+        price=f"{product['price_usd']:.2f}",
+        stock=product["stock"]
+    )
+    kb = [[InlineKeyboardButton(s["buy_from_restock"], callback_data=f"buy_{product['product_id']}")]]
+    return msg, kb
+
+
+def _digest_message(s, lang, products):
+    shown = products[:MAX_DIGEST_ITEMS]
+    lines = [s["restock_digest_header"].format(count=len(products))]
+    kb = []
+    for product in shown:
+        title = product["title_ru"] if lang == "ru" else product["title_en"]
+        lines.append(s["restock_digest_line"].format(
+            name=title,
+            price=f"{product['price_usd']:.2f}",
+            stock=product["stock"]
+        ))
+        kb.append([InlineKeyboardButton(
+            s["buy_from_restock_item"].format(name=title),
+            callback_data=f"buy_{product['product_id']}"
+        )])
+    if len(products) > len(shown):
+        lines.append(s["restock_digest_more"].format(count=len(products) - len(shown)))
+    return "\n".join(lines), kb
+
+
+async def _send_one(bot, user_id, lang, unreachable_reason, products):
+    s = STRINGS[lang]
+    if len(products) == 1:
+        msg, kb = _single_message(s, lang, products[0])
+    else:
+        msg, kb = _digest_message(s, lang, products)
+    try:
+        await send_gateway.send_message(
+            bot, user_id, msg,
+            priority=PRIORITY_BROADCAST,
+            reply_markup=InlineKeyboardMarkup(kb),
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        logger.error(f"[RESTOCK NOTIFY] Failed for {user_id}: {e}")
+        return False
+    if unreachable_reason:
+        db.clear_user_unreachable(user_id)
+    return True
+
+
+async def _fan_out(bot, product_ids):
+    products = {}
+    for product_id in product_ids:
+        product = db.get_product(product_id)
+        if product and product["stock"] > 0:
+            products[product_id] = product
+    if not products:
+        return
+
+    # One message per user, covering every restocked product they favorited
+    jobs = []
+    for user_id, rows in groupby(db.get_restock_recipients(list(products)), key=lambda r: r['user_id']):
+        rows = list(rows)
+        lang = rows[0]['language'] or "en"
+        jobs.append((user_id, lang, rows[0]['unreachable_reason'], [products[r['product_id']] for r in rows]))
+
+    sent = 0
+    for i in range(0, len(jobs), SEND_BATCH_SIZE):
+        batch = jobs[i:i + SEND_BATCH_SIZE]
+        results = await asyncio.gather(*(_send_one(bot, *job) for job in batch))
+        sent += sum(results)
+    logger.info(f"[RESTOCK NOTIFY] Products {list(products)}: sent {sent}/{len(jobs)} messages")
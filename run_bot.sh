@@ -40,7 +40,8 @@ sleep 2
 
 # Start bot
 echo "[$(date)] Starting bot.py..." | tee -a "$SUPERVISOR_LOG"
-nohup python3 bot.py >> "$BOT_LOG" 2>&1 &
+# bot.py writes and rotates $BOT_LOG itself; only stray output/crashes land in bot.out
+LOG_CONSOLE=0 nohup python3 bot.py >> "$LOG_DIR/bot.out" 2>&1 &
 BOT_PID=$!
 echo $BOT_PID > "$BOT_PID_FILE"
 echo "[$(date)] Bot started with PID: $BOT_PID" | tee -a "$SUPERVISOR_LOG"
@@ -50,7 +51,7 @@ sleep 3
 
 # Start webhook server
 echo "[$(date)] Starting webhook_server.py..." | tee -a "$SUPERVISOR_LOG"
-nohup python3 webhook_server.py >> "$WEBHOOK_LOG" 2>&1 &
+LOG_CONSOLE=0 nohup python3 webhook_server.py >> "$LOG_DIR/webhook.out" 2>&1 &
 WEBHOOK_PID=$!
 echo $WEBHOOK_PID > "$WEBHOOK_PID_FILE"
 echo "[$(date)] Webhook server started with PID: $WEBHOOK_PID" | tee -a "$SUPERVISOR_LOG"
@@ -0,0 +1,252 @@
+"""
+Central outbound Telegram send gateway.
+
+Every fan-out send (deliveries, payment confirmations, restock notices,
+broadcasts) goes through one prioritized queue per bot. A dispatcher pops the
+highest-priority job, enforces Telegram's global and per-chat limits with
+token buckets and honours RetryAfter by pausing dispatch, so a broadcast can
+never hold a paid delivery behind it.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import database as db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Priority classes: lower value is sent first
+PRIORITY_DELIVERY = 0
+PRIORITY_REPLY = 1
+PRIORITY_BROADCAST = 2
+PRIORITY_NAMES = {
+    PRIORITY_DELIVERY: "delivery",
+    PRIORITY_REPLY: "reply",
+    PRIORITY_BROADCAST: "broadcast",
+}
+
+# Telegram allows ~30 msg/s per bot and ~1 msg/s per chat; keep some headroom
+# for interactive replies that are sent directly from handlers.
+GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+GLOBAL_BURST = float(os.getenv("TG_GLOBAL_BURST", "25"))
+PER_CHAT_RATE = float(os.getenv("TG_PER_CHAT_RATE", "1"))
+PER_CHAT_BURST = float(os.getenv("TG_PER_CHAT_BURST", "3"))
+MAX_IN_FLIGHT = int(os.getenv("TG_MAX_IN_FLIGHT", "32"))
+MAX_RETRY_AFTER_ATTEMPTS = 5
+
+QUEUE_DEPTH = metrics.gauge("telegram_send_queue_depth", "Queued outbound Telegram sends", ["priority"])
+SEND_SECONDS = metrics.histogram("telegram_send_seconds", "Telegram API call latency", ["method", "priority"])
+SEND_ERRORS = metrics.counter("telegram_send_errors_total", "Failed Telegram API calls", ["method", "error"])
+
+
+def unreachable_reason(error):
+    """Classify a send error that means the chat will not accept messages,
+    or return None for errors worth retrying later."""
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        if "deactivated" in message:
+            return "deactivated"
+        return "blocked"
+    if isinstance(error, BadRequest) and "chat not found" in message:
+        return "chat_not_found"
+    return None
+
+
+class TokenBucket:
+    """Classic token bucket; time is taken from time.monotonic()."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until one token is available (0 if available now)."""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ("method", "chat_id", "kwargs", "future", "priority", "attempts")
+
+    def __init__(self, method, chat_id, kwargs, future, priority):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = future
+        self.priority = priority
+        self.attempts = 0
+
+
+class SendGateway:
+    def __init__(self, bot):
+        self.bot = bot
+        self._queue = None
+        self._seq = itertools.count()
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chats = {}
+        self._paused_until = 0.0
+        self._slots = None
+        self._dispatcher = None
+        self._loop = None
+        self._depth = dict.fromkeys(PRIORITY_NAMES, 0)
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._dispatcher.done():
+            self._loop = loop
+            self._queue = asyncio.PriorityQueue()
+            self._slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+            self._depth = dict.fromkeys(PRIORITY_NAMES, 0)
+            self._dispatcher = loop.create_task(self._dispatch())
+
+    def queue_depth(self):
+        """Queued (not yet dispatched) sends per priority class name."""
+        return {PRIORITY_NAMES[p]: n for p, n in self._depth.items()}
+
+    def _track(self, priority, delta):
+        self._depth[priority] += delta
+        QUEUE_DEPTH.set(self._depth[priority], priority=PRIORITY_NAMES[priority])
+
+    async def send(self, method, chat_id, priority=PRIORITY_REPLY, **kwargs):
+        """Queue `bot.<method>(chat_id=chat_id, **kwargs)` and wait for its result.
+        Telegram errors other than RetryAfter are raised to the caller."""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(method, chat_id, kwargs, future, priority)
+        self._track(priority, +1)
+        self._queue.put_nowait((priority, next(self._seq), job))
+        return await future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Drop idle chats; a full bucket carries no state worth keeping
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_full()}
+            bucket = self._chats[chat_id] = TokenBucket(PER_CHAT_RATE, PER_CHAT_BURST)
+        return bucket
+
+    def _requeue_later(self, delay, priority, seq, job):
+        loop = asyncio.get_running_loop()
+        loop.call_later(delay, self._queue.put_nowait, (priority, seq, job))
+
+    async def _dispatch(self):
+        while True:
+            try:
+                # Wait for capacity before popping, so the job chosen is the best one
+                # available at send time rather than at the time we started waiting.
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                wait = self._global.wait_time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                priority, seq, job = await self._queue.get()
+                if job.future.cancelled():
+                    self._track(priority, -1)
+                    continue
+
+                bucket = self._chat_bucket(job.chat_id)
+                chat_wait = bucket.wait_time()
+                if chat_wait > 0:
+                    self._requeue_later(chat_wait, priority, seq, job)
+                    continue
+
+                if self._paused_until > time.monotonic():
+                    self._queue.put_nowait((priority, seq, job))
+                    continue
+
+                self._global.consume()
+                bucket.consume()
+                self._track(priority, -1)
+                await self._slots.acquire()
+                asyncio.create_task(self._send(priority, seq, job))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[GATEWAY] dispatcher error: {e}")
+
+    async def _send(self, priority, seq, job):
+        started = time.perf_counter()
+        try:
+            method = getattr(self.bot, job.method)
+            try:
+                result = await method(chat_id=job.chat_id, **job.kwargs)
+            finally:
+                SEND_SECONDS.observe(time.perf_counter() - started, method=job.method, priority=PRIORITY_NAMES[priority])
+        except RetryAfter as e:
+            SEND_ERRORS.inc(method=job.method, error="RetryAfter")
+            retry_after = e.retry_after
+            seconds = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+            job.attempts += 1
+            logger.warning(f"[GATEWAY] RetryAfter {seconds}s on {job.method} chat={job.chat_id}")
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            if job.attempts > MAX_RETRY_AFTER_ATTEMPTS:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self._track(priority, +1)
+                self._queue.put_nowait((priority, seq, job))
+        except Exception as e:
+            SEND_ERRORS.inc(method=job.method, error=type(e).__name__)
+            reason = unreachable_reason(e)
+            if reason and isinstance(job.chat_id, int) and job.chat_id > 0:
+                # Remember dead chats so fan-outs stop spending API calls on them
+                try:
+                    db.mark_user_unreachable(job.chat_id, reason)
+                except Exception as db_error:
+                    logger.error(f"[GATEWAY] could not record unreachable chat {job.chat_id}: {db_error}")
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._slots.release()
+
+
+_gateways = {}
+
+
+def get_gateway(bot) -> SendGateway:
+    """One gateway per bot instance (one per process in practice)."""
+    gateway = _gateways.get(id(bot))
+    if gateway is None or gateway.bot is not bot:
+        gateway = _gateways[id(bot)] = SendGateway(bot)
+    return gateway
+
+
+async def send_message(bot, chat_id, text, priority=PRIORITY_REPLY, **kwargs):
+    return await get_gateway(bot).send("send_message", chat_id, priority, text=text, **kwargs)
+
+
+async def send_document(bot, chat_id, document, priority=PRIORITY_DELIVERY, **kwargs):
+    return await get_gateway(bot).send("send_document", chat_id, priority, document=document, **kwargs)
+
+
+async def edit_message_text(bot, chat_id, message_id, text, priority=PRIORITY_REPLY, **kwargs):
+    return await get_gateway(bot).send("edit_message_text", chat_id, priority, message_id=message_id, text=text, **kwargs)
@@ -0,0 +1,188 @@
+"""
+Opt-in SQL tracer and N+1 detector.
+
+With SQL_TRACE=1, database.get_connection() installs on_statement() as the
+connection's sqlite trace callback, and the timed cursor reports each
+statement's duration through observe(). Statements are grouped by normalised
+SQL (literals and bound values replaced with '?') and charged to the current
+scope: one Telegram update (perf wraps every handler in scope()), one
+webhook HTTP request, or one webhook inbox row as the workers process it.
+A scope that runs the same statement more than SQL_TRACE_REPEAT times is
+logged as an N+1 suspect.
+
+Per-scope aggregates are written as JSON to SQL_TRACE_REPORT at exit (and on
+write_report()), with sorted keys so reports can be diffed between releases.
+Statements issued outside any scope (background loops) are aggregated under
+"background" and never flagged.
+"""
+import atexit
+import contextlib
+import contextvars
+import datetime as dt
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("SQL_TRACE", "0").lower() in ("1", "true", "yes")
+REPORT_PATH = os.getenv("SQL_TRACE_REPORT", "logs/sql_trace.json")
+# Same statement more often than this within one update = N+1 suspect
+REPEAT_THRESHOLD = int(os.getenv("SQL_TRACE_REPEAT", "5"))
+
+BACKGROUND_SCOPE = "background"
+
+_current = contextvars.ContextVar("sql_trace_scope", default=None)
+_lock = threading.Lock()
+_report = {}
+_exit_hook_registered = False
+
+_STRING_RE = re.compile(r"[xX]?'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_NULL_RE = re.compile(r"\bNULL\b", re.IGNORECASE)
+_PARAM_RE = re.compile(r"\?\d*|[:@$][A-Za-z_]\w*")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(sql):
+    """Collapse a statement (template or expanded) to a grouping key."""
+    sql = _STRING_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _NULL_RE.sub("?", sql)
+    sql = _PARAM_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(?, ...)", sql)
+    return _SPACE_RE.sub(" ", sql).strip().rstrip(";")
+
+
+class _Scope:
+    """Statements issued while handling one update or request."""
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = {}  # normalised sql -> [count, seconds]
+        self.lock = threading.Lock()
+
+    def add(self, key, count, seconds):
+        with self.lock:
+            entry = self.statements.setdefault(key, [0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+
+
+def _scope_report(name):
+    report = _report.get(name)
+    if report is None:
+        report = _report[name] = {
+            "runs": 0, "queries": 0, "max_queries": 0, "seconds": 0.0,
+            "statements": {}, "n_plus_one": {},
+        }
+    return report
+
+
+def _merge(scope, flag=True):
+    queries = sum(count for count, _ in scope.statements.values())
+    with _lock:
+        report = _scope_report(scope.name)
+        report["runs"] += 1
+        report["queries"] += queries
+        report["max_queries"] = max(report["max_queries"], queries)
+        for key, (count, seconds) in scope.statements.items():
+            stmt = report["statements"].setdefault(key, {"count": 0, "seconds": 0.0, "max_per_run": 0})
+            stmt["count"] += count
+            stmt["seconds"] += seconds
+            stmt["max_per_run"] = max(stmt["max_per_run"], count)
+            report["seconds"] += seconds
+            if flag and count > REPEAT_THRESHOLD:
+                report["n_plus_one"][key] = max(report["n_plus_one"].get(key, 0), count)
+    if not flag:
+        return
+    for key, (count, _) in scope.statements.items():
+        if count > REPEAT_THRESHOLD:
+            logger.warning(f"[SQL TRACE] N+1 suspect in {scope.name}: {count}x {key[:200]}")
+
+
+_background = _Scope(BACKGROUND_SCOPE)
+
+
+def _target():
+    return _current.get() or _background
+
+
+def on_statement(sql):
+    """sqlite3 trace callback: count one executed statement."""
+    if sql.startswith("--"):
+        # Trigger sub-statements are reported as comments
+        return
+    _target().add(normalize(sql), 1, 0.0)
+
+
+def observe(sql, seconds):
+    """Charge a timed cursor execute to the statement's key (count comes from the trace callback)."""
+    if ENABLED:
+        _target().add(normalize(sql), 0, seconds)
+
+
+@contextlib.contextmanager
+def scope(name):
+    """Attribute statements issued inside the block to `name`. No-op unless SQL_TRACE is on."""
+    if not ENABLED or _current.get() is not None:
+        # Nested scopes (e.g. a handler inside a traced request) count towards the outer one
+        yield
+        return
+    _register_exit_hook()
+    current = _Scope(name)
+    token = _current.set(current)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        _merge(current)
+
+
+def write_report(path=None):
+    """Write the aggregated report as JSON. Returns the path written."""
+    path = path or REPORT_PATH
+    with _background.lock:
+        background = _Scope(BACKGROUND_SCOPE)
+        background.statements, _background.statements = _background.statements, {}
+    _merge(background, flag=False)
+    with _lock:
+        scopes = json.loads(json.dumps(_report))
+    for report in scopes.values():
+        report["seconds"] = round(report["seconds"], 6)
+        for stmt in report["statements"].values():
+            stmt["seconds"] = round(stmt["seconds"], 6)
+    payload = {
+        "generated_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        "repeat_threshold": REPEAT_THRESHOLD,
+        "scopes": scopes,
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+    return path
+
+
+def _write_at_exit():
+    try:
+        path = write_report()
+        logger.info(f"[SQL TRACE] Report written to {path}")
+    except Exception as e:
+        logger.error(f"[SQL TRACE] Could not write report: {e}")
+
+
+def _register_exit_hook():
+    # Registered on first use rather than at import: atexit runs hooks in
+    # reverse order, so this must come after log_pipeline.setup() registers
+    # its listener's stop, or the report's log line would be dropped
+    global _exit_hook_registered
+    if not _exit_hook_registered:
+        _exit_hook_registered = True
+        atexit.register(_write_at_exit)
@@ -0,0 +1,172 @@
+"""
+Bulk stock import from uploaded documents.
+
+An admin can upload a .txt, .csv or .zip file instead of pasting codes into
+a message. The document is downloaded to a temporary file and streamed line
+by line: each line (or the first column of a CSV row) is validated, then
+inserted into stock_items in chunks of IMPORT_CHUNK_SIZE rows, one
+transaction per chunk. Duplicates (within the file or against the product's
+existing stock, sold items included) are rejected by the content_hash
+unique index, so nothing but the current chunk is ever held in memory. The
+admin's status message is edited with progress while the import runs.
+"""
+import asyncio
+import csv
+import html
+import io
+import itertools
+import logging
+import os
+import tempfile
+import time
+import zipfile
+
+import database as db
+import send_gateway
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = 1000
+MAX_CODE_LENGTH = 512
+PROGRESS_EDIT_INTERVAL = 2.0
+# Bot API limit for getFile downloads
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+
+SUPPORTED_EXTENSIONS = ('.txt', '.csv', '.zip')
+# A first CSV row with one of these in column one is a header, not a code
+CSV_HEADER_NAMES = ('code', 'codes', 'key', 'content')
+
+
+def is_supported(filename):
+    return bool(filename) and filename.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def _bounded_lines(stream, stats):
+    """Yield lines, dropping (and counting) lines longer than MAX_CODE_LENGTH
+    without ever reading them into memory whole."""
+    while True:
+        line = stream.readline(MAX_CODE_LENGTH + 2)
+        if not line:
+            return
+        if len(line) == MAX_CODE_LENGTH + 2 and not line.endswith('\n'):
+            while line and not line.endswith('\n'):
+                line = stream.readline(MAX_CODE_LENGTH + 2)
+            stats['invalid'] += 1
+            continue
+        yield line
+
+
+def _valid(code):
+    return 0 < len(code) <= MAX_CODE_LENGTH and code.isprintable()
+
+
+def _codes_from_stream(stream, name, stats):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    lines = _bounded_lines(text, stats)
+    if name.lower().endswith('.csv'):
+        rows = ((row[0] if row else '') for row in csv.reader(lines))
+        first = next(rows, '')
+        if first.strip().lower() not in CSV_HEADER_NAMES:
+            rows = itertools.chain((first,), rows)
+    else:
+        rows = lines
+    for raw in rows:
+        code = raw.strip()
+        if not code:
+            continue
+        if not _valid(code):
+            stats['invalid'] += 1
+            continue
+        stats['read'] += 1
+        yield code
+
+
+def _iter_codes(path, filename, stats):
+    """Stream validated codes from a .txt/.csv file or every .txt/.csv in a .zip."""
+    if filename.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or not is_supported(member.filename) or member.filename.lower().endswith('.zip'):
+                    continue
+                with archive.open(member) as stream:
+                    yield from _codes_from_stream(stream, member.filename, stats)
+    else:
+        with open(path, 'rb') as stream:
+            yield from _codes_from_stream(stream, filename, stats)
+
+
+def _chunks(codes):
+    chunk = []
+    for code in codes:
+        chunk.append(code)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _progress_text(filename, stats, done=False):
+    head = "✅ <b>Import finished</b>" if done else "⏳ <b>Importing stock...</b>"
+    return (
+        f"{head}\n"
+        f"📄 {html.escape(filename)}\n"
+        f"• Read: {stats['read']}\n"
+        f"• Added: {stats['added']}\n"
+        f"• Duplicates skipped: {stats['read'] - stats['added']}\n"
+        f"• Invalid lines: {stats['invalid']}"
+    )
+
+
+async def _edit_progress(bot, message, text):
+    try:
+        await send_gateway.edit_message_text(bot, message.chat_id, message.message_id, text, parse_mode='HTML')
+    except Exception as e:
+        logger.warning(f"[STOCK IMPORT] Could not edit progress message: {e}")
+
+
+async def import_document(bot, message, product_id, type_str='code'):
+    """Import the document attached to `message` into a product's stock.
+    Returns the stats dict (read, added, invalid), or None if the file was refused."""
+    document = message.document
+    filename = document.file_name or 'upload.txt'
+    if not is_supported(filename):
+        await message.reply_text("❌ Unsupported file. Upload a .txt, .csv or .zip file.")
+        return None
+    if document.file_size and document.file_size > MAX_DOWNLOAD_BYTES:
+        await message.reply_text("❌ File is larger than 20 MB. Split it or zip it.")
+        return None
+
+    stats = {'read': 0, 'added': 0, 'invalid': 0}
+    status = await message.reply_text(_progress_text(filename, stats), parse_mode='HTML')
+
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+    os.close(fd)
+    chunks = None
+    try:
+        tg_file = await bot.get_file(document.file_id)
+        await tg_file.download_to_drive(path)
+
+        # Parsing and inserting both block, so each step runs in a worker thread
+        chunks = _chunks(_iter_codes(path, filename, stats))
+        last_edit = time.monotonic()
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            stats['added'] += await asyncio.to_thread(db.import_stock_chunk, product_id, type_str, chunk)
+            if time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL:
+                last_edit = time.monotonic()
+                await _edit_progress(bot, status, _progress_text(filename, stats))
+    except (zipfile.BadZipFile, csv.Error) as e:
+        await _edit_progress(bot, status, f"❌ Could not read file: {html.escape(str(e))}\n\n" + _progress_text(filename, stats))
+        return stats
+    finally:
+        if chunks is not None:
+            chunks.close()
+        os.remove(path)
+
+    logger.info(f"[STOCK IMPORT] product_id={product_id} file={filename} read={stats['read']} "
+          f"added={stats['added']} invalid={stats['invalid']}")
+    await _edit_progress(bot, status, _progress_text(filename, stats, done=True))
+    return stats
@@ -62,6 +62,10 @@ STRINGS = {
         "favorite_added_success": "✅ Добавлено в избранное. Мы уведомим вас при пополнении.",
         "restock_notification": "✅ Товар снова в наличии:\n<b>{name}</b>\nЦена: {price}$ | Остаток: {stock} шт.",
         "buy_from_restock": "🛒 Купить",
+        "restock_digest_header": "✅ Снова в наличии ({count}):",
+        "restock_digest_line": "• <b>{name}</b> — {price}$ | {stock} шт.",
+        "restock_digest_more": "…и ещё {count}",
+        "buy_from_restock_item": "🛒 {name}",
         "profile_text": "👤 <b>Ваш профиль:</b>\n\n────────────────────\n\n🪣 Мой ID: <code>{user_id}</code>\n\n💰 Мой баланс: {balance} $\n\n🛒 Количество покупок: {purchases_count}\n\n⏱ Регистрация: {registered_at}\n\n────────────────────\nℹ️ <i>Usernames update automatically when users interact.</i>",
         # Profile buttons
         "btn_topup": "💰 Пополнить баланс",
@@ -151,6 +155,10 @@ STRINGS = {
         "favorite_added_success": "✅ Added to favorites. We’ll notify you when it’s restocked.",
         "restock_notification": "✅ Back in stock:\n<b>{name}</b>\nPrice: {price}$ | Stock: {stock} pcs.",
         "buy_from_restock": "🛒 Buy",
+        "restock_digest_header": "✅ Back in stock ({count}):",
+        "restock_digest_line": "• <b>{name}</b> — {price}$ | {stock} pcs.",
+        "restock_digest_more": "…and {count} more",
+        "buy_from_restock_item": "🛒 {name}",
         "profile_text": "👤 <b>Your profile:</b>\n\n────────────────────\n\n🪣 My ID: <code>{user_id}</code>\n\n💰 My balance: {balance} $\n\n🛒 Purchases: {purchases_count}\n\n⏱ Registration: {registered_at}\n\n────────────────────\nℹ️ <i>Usernames update automatically when users interact.</i>",
         # Profile buttons
         "btn_topup": "💰 Top up balance",
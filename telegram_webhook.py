@@ -0,0 +1,114 @@
+"""
+Telegram webhook ingestion for bot.py.
+
+When TELEGRAM_WEBHOOK_URL is set, bot.main() calls serve() instead of
+run_polling(): Telegram POSTs each update to
+TELEGRAM_WEBHOOK_URL/TELEGRAM_WEBHOOK_PATH, a small FastAPI app served by
+uvicorn inside the bot process checks the X-Telegram-Bot-Api-Secret-Token
+header and puts the update on application.update_queue, and the Application
+dispatches it exactly as it would a polled update. The route answers as soon
+as the update is queued; handlers never run on the request.
+
+The secret defaults to a value derived from the bot token, so every replica
+behind a load balancer agrees on it without extra configuration.
+"""
+import hashlib
+import hmac
+import logging
+import os
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_LISTEN = os.getenv("TELEGRAM_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8080"))
+# Parallel HTTPS connections Telegram may open to us (Bot API allows 1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "40"))
+# Telegram queues updates while we are down; keep them across restarts unless told otherwise
+DROP_PENDING_UPDATES = os.getenv("TELEGRAM_WEBHOOK_DROP_PENDING", "0").lower() in ("1", "true", "yes")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+UPDATES_RECEIVED = metrics.counter(
+    "telegram_webhook_updates_total", "Telegram webhook requests by result", ["result"]
+)
+
+
+def enabled():
+    return bool(WEBHOOK_URL)
+
+
+def secret_token(bot_token):
+    """TELEGRAM_WEBHOOK_SECRET, or a stable secret derived from the bot token."""
+    configured = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+    if configured:
+        return configured
+    # Bot API allows A-Z, a-z, 0-9, _ and -; a hex digest qualifies
+    return hashlib.sha256(f"telegram-webhook:{bot_token}".encode()).hexdigest()
+
+
+def build_app(application: Application, secret: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.post(f"/{WEBHOOK_PATH}")
+    async def telegram_update(request: Request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            UPDATES_RECEIVED.inc(result="forbidden")
+            raise HTTPException(status_code=403, detail="Invalid secret token")
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            UPDATES_RECEIVED.inc(result="invalid")
+            logger.warning(f"[TG WEBHOOK] Unparseable update: {e}")
+            raise HTTPException(status_code=400, detail="Invalid update")
+        await application.update_queue.put(update)
+        UPDATES_RECEIVED.inc(result="queued")
+        return {"ok": True}
+
+    @app.get("/healthz")
+    async def healthz():
+        return {"ok": application.running}
+
+    return app
+
+
+async def serve(application: Application) -> None:
+    """Run the Application fed by a webhook until uvicorn gets SIGINT/SIGTERM."""
+    secret = secret_token(application.bot.token)
+    config = uvicorn.Config(
+        build_app(application, secret), host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, log_config=None
+    )
+    server = uvicorn.Server(config)
+
+    # Same lifecycle run_polling() drives: initialize, post_init, start ... stop, shutdown
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        await application.start()
+        logger.info(f"[TG WEBHOOK] Receiving updates at {WEBHOOK_URL}/{WEBHOOK_PATH} "
+                    f"(listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT})")
+        try:
+            await server.serve()
+        finally:
+            # The webhook stays registered: Telegram queues updates while we are
+            # down and delivers them on restart (unless TELEGRAM_WEBHOOK_DROP_PENDING)
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
@@ -34,13 +34,13 @@ check_bot() {
     
     if [ "$bot_count" -eq 0 ]; then
         echo "[$(date)] ⚠️ Bot is DOWN! Restarting..." | tee -a "$WATCHDOG_LOG"
-        nohup python3 bot.py >> "$LOG_DIR/bot.log" 2>&1 &
+        LOG_CONSOLE=0 nohup python3 bot.py >> "$LOG_DIR/bot.out" 2>&1 &
         echo "[$(date)] ✅ Bot restarted with PID: $!" | tee -a "$WATCHDOG_LOG"
     elif [ "$bot_count" -gt 1 ]; then
         echo "[$(date)] ⚠️ Multiple bot instances detected ($bot_count)! Killing all..." | tee -a "$WATCHDOG_LOG"
         pkill -9 -f "python3 bot.py"
         sleep 2
-        nohup python3 bot.py >> "$LOG_DIR/bot.log" 2>&1 &
+        LOG_CONSOLE=0 nohup python3 bot.py >> "$LOG_DIR/bot.out" 2>&1 &
         echo "[$(date)] ✅ Bot restarted with PID: $!" | tee -a "$WATCHDOG_LOG"
     fi
 }
@@ -51,13 +51,13 @@ check_webhook() {
     
     if [ "$webhook_count" -eq 0 ]; then
         echo "[$(date)] ⚠️ Webhook server is DOWN! Restarting..." | tee -a "$WATCHDOG_LOG"
-        nohup python3 webhook_server.py >> "$LOG_DIR/webhook.log" 2>&1 &
+        LOG_CONSOLE=0 nohup python3 webhook_server.py >> "$LOG_DIR/webhook.out" 2>&1 &
         echo "[$(date)] ✅ Webhook server restarted with PID: $!" | tee -a "$WATCHDOG_LOG"
     elif [ "$webhook_count" -gt 1 ]; then
         echo "[$(date)] ⚠️ Multiple webhook instances detected ($webhook_count)! Killing all..." | tee -a "$WATCHDOG_LOG"
         pkill -9 -f "python3 webhook_server.py"
         sleep 2
-        nohup python3 webhook_server.py >> "$LOG_DIR/webhook.log" 2>&1 &
+        LOG_CONSOLE=0 nohup python3 webhook_server.py >> "$LOG_DIR/webhook.out" 2>&1 &
         echo "[$(date)] ✅ Webhook server restarted with PID: $!" | tee -a "$WATCHDOG_LOG"
     fi
 }
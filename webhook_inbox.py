@@ -0,0 +1,116 @@
+"""
+Worker pool draining the durable webhook inbox.
+
+The webhook endpoint only persists verified updates (database.inbox_add) and
+acknowledges; the workers here claim rows, run the handler and mark them done.
+A row whose handler raises is retried with backoff; a row whose worker dies
+mid-processing is reclaimed once its lease expires (at-least-once delivery),
+so handlers must be idempotent.
+"""
+import asyncio
+import json
+import logging
+import time
+
+import database as db
+import metrics
+import sql_trace
+
+logger = logging.getLogger(__name__)
+
+INBOX_DEPTH = metrics.gauge("webhook_inbox_depth", "Webhook inbox rows waiting or being processed")
+INBOX_OLDEST_AGE = metrics.gauge("webhook_inbox_oldest_age_seconds", "Age of the oldest unprocessed inbox row")
+INBOX_LAG = metrics.histogram(
+    "webhook_inbox_processing_lag_seconds", "Time from webhook receipt to processing completion"
+)
+INBOX_PROCESSED = metrics.counter("webhook_inbox_processed_total", "Inbox rows handled by result", ["result"])
+
+
+class InboxWorkerPool:
+    def __init__(self, handler, workers=4, poll_interval=1.0, lease_seconds=120,
+                 max_attempts=10, retry_base=5.0, retry_cap=600.0):
+        """handler: async callable taking the decoded update dict."""
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self._wakeup = None
+        self._tasks = []
+
+    def start(self):
+        """Start the workers and the stats sampler on the running loop."""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        for n in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(n)))
+        self._tasks.append(asyncio.create_task(self._sample_stats()))
+        logger.info(f"[INBOX] Started {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """Wake idle workers after a new row was added."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _wait_for_work(self):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _worker(self, n):
+        while True:
+            try:
+                row = db.inbox_claim(self.lease_seconds)
+            except Exception as e:
+                logger.error(f"[INBOX] worker={n} claim failed: {e}")
+                row = None
+
+            if not row:
+                await self._wait_for_work()
+                continue
+
+            await self._process(row)
+
+    async def _process(self, row):
+        inbox_id = row['id']
+        try:
+            update = json.loads(row['body'])
+            # The real per-webhook work happens here, not in the HTTP request
+            with sql_trace.scope(f"webhook:{row['update_type'] or 'unknown'}"):
+                await self.handler(update)
+        except Exception as e:
+            delay = min(self.retry_cap, self.retry_base * (2 ** (row['attempts'] - 1)))
+            logger.error(f"[INBOX] Row {inbox_id} failed (attempt {row['attempts']}): {e}")
+            db.inbox_fail(inbox_id, e, delay, self.max_attempts)
+            result = "failed" if row['attempts'] >= self.max_attempts else "retry"
+            INBOX_PROCESSED.inc(result=result)
+            return
+
+        db.inbox_complete(inbox_id)
+        INBOX_PROCESSED.inc(result="ok")
+        INBOX_LAG.observe(time.time() - row['received_at'])
+
+    async def _sample_stats(self, interval=5.0, purge_every=3600.0):
+        last_purge = 0.0
+        while True:
+            try:
+                stats = db.inbox_stats()
+                INBOX_DEPTH.set(stats['depth'])
+                INBOX_OLDEST_AGE.set(time.time() - stats['oldest'] if stats['oldest'] else 0)
+                if time.monotonic() - last_purge > purge_every:
+                    last_purge = time.monotonic()
+                    db.inbox_purge()
+            except Exception as e:
+                logger.error(f"[INBOX] stats sampling failed: {e}")
+            await asyncio.sleep(interval)
@@ -1,17 +1,27 @@
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import Response
 import uvicorn
+import asyncio
 import os
+import time
 import hashlib
 import hmac
 from telegram import Bot
 import database as db
 import delivery_service
+import metrics
+import loop_monitor
+import sql_trace
+import send_gateway
+from send_gateway import PRIORITY_DELIVERY
+from webhook_inbox import InboxWorkerPool
 import logging
+import log_pipeline
 import json
 from dotenv import load_dotenv
 
 # Configure logs
-logging.basicConfig(level=logging.INFO)
+log_pipeline.setup("webhook")
 logger = logging.getLogger("WEBHOOK")
 
 load_dotenv()
@@ -21,15 +31,22 @@ app = FastAPI()
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 WEBHOOK_SECRET_PATH = os.getenv("WEBHOOK_SECRET_PATH", "secret-path")
 CRYPTO_PAY_TOKEN = os.getenv("CRYPTO_PAY_API_TOKEN")
+INBOX_WORKERS = int(os.getenv("INBOX_WORKERS", "4"))
 
 if not CRYPTO_PAY_TOKEN:
     logger.warning("CRYPTO_PAY_API_TOKEN is missing")
 
 bot = Bot(token=BOT_TOKEN)
 
+REQUEST_SECONDS = metrics.histogram("webhook_request_seconds", "Webhook HTTP request latency", ["route", "status"])
+INVOICE_PAID_SECONDS = metrics.histogram(
+    "invoice_paid_processing_seconds", "Time to apply an invoice_paid update (credit or pay + deliver)", ["kind", "result"]
+)
+
 def verify_signature(body: bytes, signature: str) -> bool:
     if not CRYPTO_PAY_TOKEN:
-        return True 
+        # Nothing to verify against: fail closed
+        return False
     secret = hashlib.sha256(CRYPTO_PAY_TOKEN.encode()).digest()
     computed_signature = hmac.new(
         key=secret,
@@ -38,32 +55,8 @@ def verify_signature(body: bytes, signature: str) -> bool:
     ).hexdigest()
     return hmac.compare_digest(computed_signature, signature)
 
-@app.post("/{secret_path}")
-async def crypto_webhook(secret_path: str, request: Request):
-    """Handle incoming Crypto Pay webhooks."""
-    if secret_path != WEBHOOK_SECRET_PATH:
-        logger.warning(f"Invalid path accessed: {secret_path}")
-        raise HTTPException(status_code=403, detail="Invalid path")
-    
-    signature = request.headers.get("crypto-pay-api-signature")
-    body = await request.body()
-    
-    # logger.info(f"[WEBHOOK] Received payload. Size: {len(body)}")
-    
-    if signature:
-        if not verify_signature(body, signature):
-             logger.error("Invalid signature")
-             # Proceeding with caution or return 403
-             # raise HTTPException(status_code=403, detail="Invalid signature")
-    else:
-        logger.warning("No signature header received")
-
-    try:
-        update = await request.json()
-        logger.info(f"[WEBHOOK] JSON: {json.dumps(update)}")
-    except:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
-    
+async def process_update(update: dict):
+    """Apply one CryptoPay update. Runs on the inbox workers; must stay idempotent."""
     update_type = update.get("update_type")
     
     if update_type == "invoice_paid":
@@ -77,63 +70,154 @@ async def crypto_webhook(secret_path: str, request: Request):
 
         if not invoice_id:
              logger.error("No invoice_id found in payload")
-             return {"ok": True}
+             return
+
+        # Repeats (CryptoPay retries, a lease-reclaimed inbox row, or the
+        # "Check Payment" button) are absorbed by the paid compare-and-sets
+        await handle_invoice_paid(invoice_id, payload)
+
+async def handle_invoice_paid(invoice_id, payload: dict):
+    """Credit a topup or mark an order paid and deliver it (timed by kind and result)."""
+    # One primary-key lookup tells us what this invoice pays for
+    invoice = db.get_invoice(invoice_id)
+    if not invoice:
+        logger.error(f"[WEBHOOK] Unknown invoice {invoice_id}")
+        return
+    started = time.perf_counter()
+    result = "error"
+    try:
+        result = await _apply_invoice_paid(invoice_id, invoice, payload)
+    finally:
+        INVOICE_PAID_SECONDS.observe(time.perf_counter() - started, kind=invoice['kind'], result=result)
 
-        # Check if this is a topup payment (payload starts with "topup_")
-        invoice_payload = payload.get("payload", "")
+async def _apply_invoice_paid(invoice_id, invoice, payload: dict):
+    """Returns the outcome label: credited, duplicate, canceled, delivered or scheduled."""
+    if invoice['kind'] == 'topup':
+        import datetime as dt
         
-        # Check topup first
-        topup = db.get_topup_by_invoice(invoice_id)
-        if topup and topup['status'] != 'paid':
-            import datetime as dt
-            amount = topup['amount']
-            user_id = topup['user_id']
+        # Status change and balance credit commit together (prevents double-credit)
+        credited = db.credit_paid_topup(invoice_id, dt.datetime.now().isoformat())
+        if credited:
+            user_id, amount, new_balance = credited
+            logger.info(f"[WEBHOOK] Topup credited: user={user_id}, amount=${amount}, new_balance=${new_balance}")
             
-            # Update status (prevents double-credit)
-            updated = db.update_topup_status(invoice_id, 'paid', dt.datetime.now().isoformat())
-            if updated:
-                new_balance = db.add_user_balance(user_id, amount)
-                logger.info(f"[WEBHOOK] Topup credited: user={user_id}, amount=${amount}, new_balance=${new_balance}")
-                
-                # Send confirmation to user
-                try:
-                    lang = db.get_user_language(user_id) or "en"
-                    if lang == "ru":
-                        msg = f"✅ Оплата подтверждена. Баланс пополнен на ${amount:.2f}.\nНовый баланс: <b>${new_balance:.2f}</b>"
-                    else:
-                        msg = f"✅ Payment confirmed. Balance increased by ${amount:.2f}.\nNew balance: <b>${new_balance:.2f}</b>"
-                    await bot.send_message(chat_id=user_id, text=msg, parse_mode='HTML')
-                except Exception as e:
-                    logger.error(f"[WEBHOOK] Failed to send topup confirmation: {e}")
-            else:
-                logger.info(f"[WEBHOOK] Topup {invoice_id} already processed")
-            return {"ok": True}
-
-        # Check order in DB (existing product purchase flow)
-        order = db.get_order_by_invoice(invoice_id)
-        if not order:
-            logger.error(f"[WEBHOOK] Order not found for invoice {invoice_id}")
-            return {"ok": True}
-        
-        order_id = order["order_id"]
-        logger.info(f"[WEBHOOK] Found Order ID: {order_id} (Status: {order['status']})")
+            # Send confirmation to user
+            try:
+                lang = db.get_user_language(user_id) or "en"
+                if lang == "ru":
+                    msg = f"✅ Оплата подтверждена. Баланс пополнен на ${amount:.2f}.\nНовый баланс: <b>${new_balance:.2f}</b>"
+                else:
+                    msg = f"✅ Payment confirmed. Balance increased by ${amount:.2f}.\nNew balance: <b>${new_balance:.2f}</b>"
+                await send_gateway.send_message(bot, user_id, msg, priority=PRIORITY_DELIVERY, parse_mode='HTML')
+            except Exception as e:
+                logger.error(f"[WEBHOOK] Failed to send topup confirmation: {e}")
+            return "credited"
+        logger.info(f"[WEBHOOK] Topup {invoice_id} already processed")
+        return "duplicate"
+
+    # Product purchase
+    order_id = invoice['ref_id']
+    logger.info(f"[WEBHOOK] Found Order ID: {order_id} (Invoice status: {invoice['status']})")
+    
+    if invoice['status'] == 'canceled':
+        logger.error(f"[WEBHOOK] Invoice {invoice_id} was paid but order {order_id} is canceled")
+        return "canceled"
+    
+    # Mark as paid if not
+    if invoice['status'] == 'pending':
+        paid_asset = payload.get("asset")
+        paid_amount = payload.get("amount")
+        paid_at = payload.get("paid_at")
         
-        # Mark as paid if not
-        if order["status"] != "delivered":
-             if order["status"] != "paid":
-                 paid_asset = payload.get("asset")
-                 paid_amount = payload.get("amount")
-                 paid_at = payload.get("paid_at")
-                 
-                 db.update_order_status(order_id, "paid")
-                 db.update_order_payment(order_id, paid_amount, paid_asset, paid_at)
-                 logger.info(f"[WEBHOOK] Order {order_id} updated to PAID ({paid_amount} {paid_asset})")
-
-             # Deliver
-             success = await delivery_service.deliver_order(order_id, bot)
-             if success:
-                 logger.info(f"[WEBHOOK] Delivery SUCCESS for {order_id}")
-             else:
-                 logger.error(f"[WEBHOOK] Delivery FAILED for {order_id}")
+        # pending -> paid compare-and-set; a concurrent cancel or "Check Payment" may win
+        if db.mark_order_paid(order_id, paid_amount, paid_asset, paid_at):
+            logger.info(f"[WEBHOOK] Order {order_id} updated to PAID ({paid_amount} {paid_asset})")
+        elif (db.get_order(order_id) or {}).get('status') == 'canceled':
+            logger.error(f"[WEBHOOK] Invoice {invoice_id} was paid but order {order_id} is canceled")
+            return "canceled"
+
+    # Deliver (no-op if already delivered); failures are retried from the outbox
+    success = await delivery_service.deliver_or_schedule(order_id, bot)
+    if success:
+        logger.info(f"[WEBHOOK] Delivery SUCCESS for {order_id}")
+        return "delivered"
+    logger.error(f"[WEBHOOK] Delivery FAILED for {order_id}, left in delivery outbox")
+    return "scheduled"
+
+inbox_pool = InboxWorkerPool(process_update, workers=INBOX_WORKERS)
+loop_monitor_task = None
+
+@app.on_event("startup")
+async def start_inbox_workers():
+    global loop_monitor_task
+    inbox_pool.start()
+    loop_monitor_task = asyncio.create_task(loop_monitor.monitor_loop())
+
+@app.on_event("shutdown")
+async def stop_inbox_workers():
+    if loop_monitor_task:
+        loop_monitor_task.cancel()
+    await inbox_pool.stop()
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    # Route label, never the raw path: the webhook path is a secret
+    route = "metrics" if request.url.path == "/metrics" else "webhook"
+    started = time.perf_counter()
+    status = 500
+    try:
+        with sql_trace.scope(f"{request.method} /{route}"):
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, status=status)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus scrape endpoint for this process's registry."""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.post("/{secret_path}")
+async def crypto_webhook(secret_path: str, request: Request):
+    """Handle incoming Crypto Pay webhooks: persist to the inbox and acknowledge."""
+    if secret_path != WEBHOOK_SECRET_PATH:
+        logger.warning(f"Invalid path accessed: {secret_path}")
+        raise HTTPException(status_code=403, detail="Invalid path")
+    
+    signature = request.headers.get("crypto-pay-api-signature")
+    body = await request.body()
+    
+    # logger.info(f"[WEBHOOK] Received payload. Size: {len(body)}")
+    
+    # Only verified bodies reach the inbox; anything queued there gets paid out
+    if not signature:
+        logger.warning("[WEBHOOK] No signature header received, rejecting")
+        raise HTTPException(status_code=403, detail="Missing signature")
+    if not verify_signature(body, signature):
+        logger.error("[WEBHOOK] Invalid signature, rejecting")
+        raise HTTPException(status_code=403, detail="Invalid signature")
+
+    try:
+        update = json.loads(body)
+        # Full payload only at DEBUG; formatted lazily on the log thread
+        logger.debug("[WEBHOOK] JSON: %s", update)
+    except:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    
+    # Processing (crediting, delivery, Telegram sends) happens on the inbox workers.
+    # CryptoPay redelivers until acknowledged; the inbox keeps one row per update_id.
+    update_id = update.get("update_id")
+    inbox_id = db.inbox_add(update_id, update.get("update_type"), body.decode("utf-8"))
+    if inbox_id is None:
+        logger.info(f"[WEBHOOK] Duplicate update {update_id} dropped")
+        return {"ok": True}
+    inbox_pool.notify()
+    logger.info(f"[WEBHOOK] Queued update {update_id} as inbox #{inbox_id}")
                 
     return {"ok": True}
+
+if __name__ == "__main__":
+    db.init_db()
+    # log_config=None: uvicorn's loggers propagate into the log pipeline
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")), log_config=None)